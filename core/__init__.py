@@ -1,20 +1,18 @@
 import asyncio
 import base64
 import hashlib
-import io
+import hmac
 import time
 from typing import Optional
 import urllib.parse as urlparse
 import anyio
-import fastapi
 
-from tianxiu2b2t import units
 from tianxiu2b2t.utils import runtime
-from .abc import ResponseFileLocal, ResponseFileMemory, ResponseFileNotFound, ResponseFileRemote
+from .abc import ResponseFileLocal, ResponseFileMemory, ResponseFileNotFound, ResponseFileRemote, ResponseFileStream
 from .locale import load_languages
-from .cluster import ClusterManager
+from .cluster import ClusterManager, get_sign_expires
 from .config import API_VERSION, VERSION, cfg
-from .logger import logger
+from .logger import access_logger, logger
 from .utils import scheduler
 from .database import init as init_database
 from .dashboard import (
@@ -22,6 +20,7 @@ from .dashboard import (
     stop as stop_dashboard
 )
 from . import web
+from .workers import SharedCounters, workers
 import platform
 
 clusters: 'ClusterManager' = ClusterManager()
@@ -32,6 +31,40 @@ def init():
     except KeyboardInterrupt:
         pass
 
+def migrate(
+    names: list[str]
+):
+    try:
+        anyio.run(migrate_main, names)
+    except KeyboardInterrupt:
+        pass
+
+async def migrate_main(
+    names: list[str]
+):
+    """
+    `python main.py migrate <source> <destination>...`: copies the files of
+    one configured storage to the others, at each destination's
+    `upload_concurrency`, without connecting to the center.
+    """
+    load_languages()
+    load_storages()
+    storages = {storage.name: storage for storage in clusters.storages.storages}
+    if len(names) < 2 or any(name not in storages for name in names):
+        logger.terror("core.migrate.usage", storages=", ".join(storages))
+        return
+    try:
+        async with anyio.create_task_group() as task_group:
+            await utils.event.setup(task_group)
+
+            await clusters.storages.setup(task_group)
+
+            await clusters.migrate(storages[names[0]], [storages[name] for name in names[1:]])
+
+            task_group.cancel_scope.cancel()
+    except:
+        logger.traceback()
+
 def load_storages():
     storages = clusters.storages
     
@@ -90,16 +123,20 @@ async def main():
 
             scheduler.start()
 
+            access_logger.start()
+
             await utils.event.setup(task_group)
 
             await clusters.setup(task_group)
 
             await web.setup(task_group, clusters)
 
-            await setup_dashboard(web.app, task_group)
+            await setup_dashboard(web.app, task_group, clusters)
 
             await load_cluster_certificates()
 
+            clusters.shared_counters = workers.start(init_worker, cfg.workers, [cluster.id for cluster in clusters.clusters])
+
             await clusters.sync()
 
             # serve
@@ -110,163 +147,174 @@ async def main():
         logger.traceback()
 
     finally:
+        workers.stop()
         stop_dashboard()
         await clusters.stop()
         scheduler.shutdown(False)
+        access_logger.stop()
         await anyio.sleep(max(0, 5 - runtime.perf_counter()))
         logger.tinfo("core.exit")
 
-FORBIDDEN = fastapi.responses.Response(
-    status_code=403,
-    content="Forbidden"
-)
+def init_worker(
+    index: int,
+    counters: str
+):
+    try:
+        anyio.run(worker_main, index, counters)
+    except KeyboardInterrupt:
+        pass
+
+async def worker_main(
+    index: int,
+    counters: str
+):
+    """
+    A worker process: serves the public port (bound with SO_REUSEPORT) from
+    the same storages, while the main process keeps the cluster connections,
+    sync and keepalive. Hits are reported through shared counters.
+    """
+    load_languages()
+    load_storages()
+    load_clusters()
+    clusters.worker_index = index
+    clusters.shared_counters = SharedCounters(cfg.workers, [cluster.id for cluster in clusters.clusters], counters)
+
+    try:
+        async with anyio.create_task_group() as task_group:
+            scheduler.start()
+
+            access_logger.start()
+
+            await utils.event.setup(task_group)
+
+            await clusters.setup_worker(task_group)
+
+            await web.setup(task_group, clusters)
+
+            await setup_dashboard(web.app, task_group, clusters)
 
-@web.app.get("/measure/{size}")
-async def measure(size: int, s: str, e: str):
-    cluster_id = get_cluster_from_sign(f"/measure/{size}", s, e)
+            web.update_certificates(clusters.load_saved_certificates())
+    except asyncio.CancelledError:
+        ...
+    except:
+        logger.traceback()
+    finally:
+        stop_dashboard()
+        scheduler.shutdown(False)
+        access_logger.stop()
+        clusters.shared_counters.close()
+
+FORBIDDEN_HEADERS = web.build_headers(9, b"text/plain; charset=utf-8")
+NOT_FOUND_HEADERS = web.build_headers(9, b"text/plain; charset=utf-8")
+BAD_REQUEST_HEADERS = web.build_headers(11, b"text/plain; charset=utf-8")
+EMPTY_HEADERS = web.build_headers(0)
+MEASURE_CHUNK = b'0' * 1024 * 1024
+
+@web.application.route("/measure/")
+async def measure(scope: web.Scope, receive: web.Receive, send: web.Send):
+    raw_size = scope["path"][len("/measure/"):]
+    query = web.get_query(scope)
+    cluster_id = get_cluster_from_sign(f"/measure/{raw_size}", query.get("s", ""), query.get("e", ""))
     if cluster_id is None:
-        return FORBIDDEN
+        await web.send_response(send, 403, FORBIDDEN_HEADERS, b"Forbidden")
+        return
+    try:
+        size = int(raw_size)
+    except ValueError:
+        await web.send_response(send, 400, BAD_REQUEST_HEADERS, b"Bad Request")
+        return
 
     file = None
 
     if cfg.storage_measure:
         file = await clusters.get_measure_file(size)
     if file is not None and isinstance(file, ResponseFileRemote):
-        return fastapi.responses.RedirectResponse(
-            file.url,
-            status_code=302,
-        )
-    async def iter():
-        for _ in range(size):
-            yield b'0' * 1024 * 1024
-    return fastapi.responses.StreamingResponse(
-        iter(),
-        media_type="application/octet-stream"
-    )
-
-@web.app.get("/download/{hash}")
-async def download(request: fastapi.Request, hash: str, s: str, e: str, name: Optional[str] = None):
-    cluster_id = get_cluster_from_sign(hash, s, e)
+        await web.send_response(send, 302, web.build_headers(0, location=file.url))
+        return
+    size = max(size, 0)
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": web.build_headers(size * len(MEASURE_CHUNK)),
+    })
+    for _ in range(size):
+        await send({
+            "type": "http.response.body",
+            "body": MEASURE_CHUNK,
+            "more_body": True,
+        })
+    await send({
+        "type": "http.response.body",
+        "body": b"",
+    })
+
+@web.application.route("/download/")
+async def download(scope: web.Scope, receive: web.Receive, send: web.Send):
+    hash = scope["path"][len("/download/"):]
+    query = web.get_query(scope)
+    cluster_id = get_cluster_from_sign(hash, query.get("s", ""), query.get("e", ""))
     if cluster_id is None:
-        return FORBIDDEN
+        await web.send_response(send, 403, FORBIDDEN_HEADERS, b"Forbidden")
+        return
     file = await clusters.get_response_file(hash)
-    size = file.size
-    range = request.headers.get("Range")
-    if range:
-        size = utils.get_range_size(range, size)
+    range = None
+    try:
+        if file.size > 0:
+            range = utils.parse_range(web.get_header(scope, b"range") or "", file.size)
+    except utils.RangeNotSatisfiable as e:
+        await web.send_response(send, 416, web.build_headers(21, b"text/plain; charset=utf-8", content_range=f"bytes */{e.size}"), b"Range Not Satisfiable")
+        return
+    size = range.length if range is not None else file.size
 
     resp_headers = {}
+    name = query.get("name")
     if name:
-        resp_headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{urlparse.quote(name)}"
-    resp_headers["X-BMCLAPI-Hash"] = hash
-    resp_headers["X-BMCLAPI-Size"] = str(size)
-    clusters.hit(cluster_id, size or 0)
+        resp_headers["content_disposition"] = f"attachment; filename*=UTF-8''{urlparse.quote(name)}"
+    resp_headers["x_bmclapi_hash"] = hash
+    resp_headers["x_bmclapi_size"] = str(size)
+    clusters.hit(cluster_id, max(size, 0), hash)
 
     if isinstance(file, ResponseFileLocal):
-        return fastapi.responses.FileResponse(
-            file.path,
-            headers=resp_headers,
-        )
+        await web.send_file(send, file.path, file.size, range, web.build_headers(size, **resp_headers))
     elif isinstance(file, ResponseFileRemote):
-        return fastapi.responses.RedirectResponse(
-            file.url,
-            status_code=302,
-            headers=resp_headers,
-        )
+        await web.send_response(send, 302, web.build_headers(0, location=file.url, **resp_headers))
+    elif isinstance(file, ResponseFileStream):
+        await web.send_stream(send, file, range, web.build_headers(size, **resp_headers))
     elif isinstance(file, ResponseFileMemory):
-        result = b''
-        r = utils.parse_range(range or "")
-        if r is not None:
-            if r.start >= len(file.data) or r.end is not None and (r.end > len(file.data) or r.end < r.start):
-                return fastapi.responses.Response(
-                    status_code=416,
-                    content="Range Not Satisfiable"
-                )
         status = 200
-        if r is None:
-            result = file.data
-        elif r.end is None:
-            result = file.data[r.start:]
-        else:
-            result = file.data[r.start:r.end + 1]
-        if r is not None:
+        result = file.data
+        if range is not None:
             status = 206
-            resp_headers["Content-Range"] = f"bytes {r.start}-{len(result) + r.start - 1}/{len(file.data)}"
-        resp_headers["Content-Length"] = str(len(result))
-        return fastapi.responses.StreamingResponse(
-            io.BytesIO(result),
-            status_code=status,
-            headers=resp_headers,
-        )
+            result = file.data[range.start:range.end + 1]
+            resp_headers["content_range"] = range.content_range(len(file.data))
+        await web.send_response(send, status, web.build_headers(len(result), **resp_headers), result)
     elif isinstance(file, ResponseFileNotFound):
-        return fastapi.responses.Response(
-            status_code=404,
-            content="Not Found"
-        )
+        await web.send_response(send, 404, NOT_FOUND_HEADERS, b"Not Found")
     else:
-        return fastapi.responses.Response(
-            status_code=200,
-        )
+        await web.send_response(send, 200, EMPTY_HEADERS)
 
 @web.app.get("/robots.txt")
 def _():
     return "User-agent: *\nDisallow: /"
 
-def access_log(request: fastapi.Request, response: fastapi.Response, total_time: int):
-    raw_path = request.url.path
-    # with query params
-    if request.url.query:
-        raw_path += "?" + request.url.query
-    
-    if not config.cfg.access_log and (
-        raw_path.startswith("/download/") or raw_path.startswith("/measure/")
-    ) and response.status_code in (200, 206, 302):
-        return
-
-
-    address = request.headers.get("X-Real-IP") or ""
-    if not address and request.client:
-        sockname = (request.client.host, request.client.port)
-        address = web.get_origin_address(sockname)[0]
-    logger.tinfo(
-        "web.access_log",
-        host=request.headers.get("Host") or "",
-        method=request.method.ljust(7),
-        path=raw_path,
-        status=response.status_code,
-        total_time=units.format_count_time(total_time, 4).rjust(14),
-        user_agent=request.headers.get("User-Agent") or "",
-        address=address.ljust(16),
-    )
-
-@web.app.middleware("http")
-async def access_log_middleware(request: fastapi.Request, call_next):
-    web.query_per_second_statistics.add()
-    start_time = runtime.perf_counter_ns()
-    try:
-        result = await call_next(request)
-    except:
-        logger.traceback()
-        result = fastapi.responses.Response(
-            status_code=500,
-            content="Internal Server Error"
-        )
-
-    end_time = runtime.perf_counter_ns()
-
-    access_log(request, result, end_time - start_time)
-    # access log
-
-    return result
-
 def get_cluster_from_sign(hash: str, s: str, e: str) -> Optional[str]:
+    if not s or not e:
+        return None
+    if get_sign_expires(e) <= time.time():
+        clusters.signatures.expired += 1
+        return None
+    key = (hash, s, e)
+    cluster_id = clusters.signatures.get(key)
+    if cluster_id is not None:
+        return cluster_id
     for cluster in clusters.clusters:
         if check_sign_without_time(hash, cluster._token._secret, s, e):
+            clusters.signatures.set(key, cluster.id)
             return cluster.id
     return None
 
 def check_sign(hash: str, secret: str, s: str, e: str) -> bool:
-    return check_sign_without_time(hash, secret, s, e) and time.time() - 300 < int(e, 36)
+    return check_sign_without_time(hash, secret, s, e) and time.time() < get_sign_expires(e)
 
 def check_sign_without_time(hash: str, secret: str, s: str, e: str):
     if not s or not e:
@@ -278,4 +326,4 @@ def check_sign_without_time(hash: str, secret: str, s: str, e: str):
         .decode()
         .rstrip("=")
     )
-    return sign == s
\ No newline at end of file
+    return hmac.compare_digest(sign, s)
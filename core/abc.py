@@ -1,12 +1,14 @@
 import abc
 import enum
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator, Callable
 from cryptography import x509
 from cryptography.x509 import oid
 
 
 class BMCLAPIFile:
+    __slots__ = ("path", "hash", "size", "mtime")
+
     def __init__(
         self,
         path: str,
@@ -23,7 +25,7 @@ class BMCLAPIFile:
         return f'BMCLAPIFile(path={self.path}, hash={self.hash}, size={self.size}, mtime={self.mtime})'
     
     def __hash__(self) -> int:
-        return int(self.hash, 16)
+        return hash(self.hash)
     
     def __eq__(self, other: 'BMCLAPIFile'):
         return self.hash == other.hash
@@ -123,6 +125,19 @@ class ResponseFileMemory(ResponseFile):
     def __repr__(self) -> str:
         return f'ResponseFileMemory(data={self.data}, size={self.size})'
     
+class ResponseFileStream(ResponseFile):
+    def __init__(
+        self,
+        size: int,
+        stream: Callable[[int, int], AsyncIterator[bytes]]
+    ):
+        super().__init__(size)
+        # stream(offset, length) yields the body straight from the backend
+        self.stream = stream
+
+    def __repr__(self) -> str:
+        return f'ResponseFileStream(size={self.size})'
+    
 class ResponseFileNotFound(ResponseFile):
     def __init__(
         self,
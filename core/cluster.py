@@ -1,30 +1,34 @@
 from . import abc
 import contextlib
 import datetime
+import heapq
 import hmac
-import io
 import json
 from pathlib import Path
 import sys
+import tempfile
 import time
-from typing import Any, Optional
+from typing import IO, Any, Optional
 import aiohttp
 import anyio
 import anyio.abc
-import pyzstd as zstd
+import anyio.to_thread
+import cachetools
 import socketio
 
 from tianxiu2b2t import units
 from tianxiu2b2t.anyio import concurrency
 from tianxiu2b2t.anyio.lock import WaitLock
-from tianxiu2b2t.anyio.queues import Queue
 
 from . import utils
-from .abc import BMCLAPIFile, Certificate, CertificateType, OpenBMCLAPIConfiguration, ResponseFile, SocketEmitResult
+from .abc import BMCLAPIFile, Certificate, CertificateType, OpenBMCLAPIConfiguration, ResponseFile, ResponseFileNotFound, SocketEmitResult
 from .logger import logger
 from .config import API_VERSION, ROOT_PATH, cfg, USER_AGENT, DEBUG
-from .storage import CheckStorage, StorageManager
+from .manifest import INDEX_PATH, MANIFEST_PATH, FileTable, Manifest, SyncJournal, get_listing_path, load_listing, save_listing
+from .storage import CheckStorage, FileIndex, StorageManager
+from .storage.abc import Storage, iter_fileobj, iter_verified
 from .database import get_db
+from .workers import SharedCounters
 
 class TokenManager:
     def __init__(
@@ -151,18 +155,247 @@ class ClusterCounter:
     def clone(self):
         return ClusterCounter(self.hits, self.bytes)
 
+class SignatureCache:
+    """
+    Remembers which cluster a verified `(hash, s, e)` signature belongs to
+    until the signature expires, so repeated hits skip the sha1 per cluster.
+    """
+    def __init__(
+        self,
+        maxsize: int = 16384
+    ):
+        self._cache: cachetools.TLRUCache[tuple[str, str, str], str] = cachetools.TLRUCache(
+            maxsize=maxsize,
+            ttu=lambda key, value, now: get_sign_expires(key[2]),
+            timer=time.time
+        )
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(
+        self,
+        key: tuple[str, str, str]
+    ) -> Optional[str]:
+        cluster_id = self._cache.get(key)
+        if cluster_id is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return cluster_id
+
+    def set(
+        self,
+        key: tuple[str, str, str],
+        cluster_id: str
+    ):
+        self._cache[key] = cluster_id
+
+    def get_statistics(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "size": len(self._cache),
+        }
+
+class DownloadScheduler:
+    """
+    Order in which the missing files are downloaded, without materializing
+    the queue: one cursor per size lane over the positions of the missing
+    `FileTable`, plus a heap of failed positions waiting for their retry.
+
+    Large files only get up to `large_slots` of the running downloads, so
+    small files never wait behind a batch of big ones; either lane takes
+    all slots when the other one is empty.
+    """
+    def __init__(
+        self,
+        files: FileTable
+    ):
+        self._sizes = files.sizes
+        self._cursors = [0, 0]
+        self._retries: list[tuple[float, int, int]] = []
+        self.large_active = 0
+
+    def _peek(
+        self,
+        large: bool
+    ) -> Optional[int]:
+        sizes = self._sizes
+        cursor = self._cursors[large]
+        while cursor < len(sizes) and (sizes[cursor] > SMALL_FILE_SIZE) != large:
+            cursor += 1
+        self._cursors[large] = cursor
+        return cursor if cursor < len(sizes) else None
+
+    def _take(
+        self,
+        large: bool
+    ) -> Optional[tuple[int, int]]:
+        index = self._peek(large)
+        if index is None:
+            return None
+        self._cursors[large] = index + 1
+        return index, 0
+
+    def next(
+        self,
+        large_slots: int
+    ) -> Optional[tuple[int, int]]:
+        """position and previous attempts of the next file to download"""
+        if self._retries and self._retries[0][0] <= time.monotonic():
+            _, index, attempts = heapq.heappop(self._retries)
+            return index, attempts
+        if self.large_active < large_slots and self._peek(True) is not None:
+            return self._take(True)
+        return self._take(False) or self._take(True)
+
+    def retry(
+        self,
+        index: int,
+        attempts: int,
+        delay: float
+    ):
+        heapq.heappush(self._retries, (time.monotonic() + delay, index, attempts))
+
+    def next_retry_in(self) -> Optional[float]:
+        if not self._retries:
+            return None
+        return max(0, self._retries[0][0] - time.monotonic())
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._retries) or self._peek(False) is not None or self._peek(True) is not None
+
+class UploadJob:
+    """a verified download shared by the storages it is uploaded to"""
+    def __init__(
+        self,
+        file: BMCLAPIFile,
+        data: IO[bytes],
+        size: int,
+        threaded: bool,
+        part: Optional[Path],
+        references: int
+    ):
+        self.file = file
+        self.data = data
+        self.size = size
+        self.threaded = threaded
+        self.part = part
+        self.references = references
+
+    def release(self):
+        self.references -= 1
+        if self.references > 0:
+            return
+        self.data.close()
+        if self.part is not None:
+            self.part.unlink(missing_ok=True)
+
+class StorageUploader:
+    """
+    Uploads of one storage during a sync: a queue of `UPLOAD_QUEUE_SIZE`
+    files drained by `Storage.upload_concurrency` workers. A failed upload
+    is put back after a growing delay without holding a worker, so a slow
+    or failing storage never stalls the downloads or the other storages
+    until its queue is full.
+    """
+    def __init__(
+        self,
+        storage: Storage,
+        index: FileIndex,
+        journal: Optional[SyncJournal] = None
+    ):
+        self.storage = storage
+        self._index = index
+        self._journal = journal
+        self._send, self._receive = anyio.create_memory_object_stream[tuple[UploadJob, int]](UPLOAD_QUEUE_SIZE)
+        self._pending = 0
+        self._finishing = False
+        self.failed = 0
+
+    async def put(
+        self,
+        job: UploadJob
+    ):
+        self._pending += 1
+        await self._send.send((job, 0))
+
+    def finish(self):
+        """no more files are coming, `run` returns once the queued ones are done"""
+        self._finishing = True
+        if self._pending == 0:
+            self._send.close()
+
+    async def run(self):
+        async with anyio.create_task_group() as task_group:
+            with self._receive:
+                for _ in range(self.storage.upload_concurrency):
+                    task_group.start_soon(self._work, self._receive.clone(), task_group)
+
+    async def _work(
+        self,
+        receive: anyio.abc.ObjectReceiveStream[tuple[UploadJob, int]],
+        task_group: anyio.abc.TaskGroup
+    ):
+        async with receive:
+            async for job, retries in receive:
+                try:
+                    await self.storage.upload_download_file(job.file.hash, iter_fileobj(job.data, job.threaded), job.size)
+                    self._index.add(job.file.hash, self.storage)
+                    if self._journal is not None:
+                        self._journal.append(job.file.hash, job.size, int(job.file.mtime * 1000))
+                except:
+                    logger.debug_traceback()
+                    if retries < UPLOAD_RETRIES:
+                        delay = UPLOAD_RETRY_DELAY * (retries + 2)
+                        logger.twarning("storage.retry_upload", name=self.storage.name, times=retries + 1, time=delay)
+                        task_group.start_soon(self._retry, job, retries + 1, delay)
+                        continue
+                    self.failed += 1
+                    logger.twarning("storage.upload_failed", name=self.storage.name, hash=job.file.hash)
+                self._done(job)
+
+    async def _retry(
+        self,
+        job: UploadJob,
+        retries: int,
+        delay: float
+    ):
+        await anyio.sleep(delay)
+        await self._send.send((job, retries))
+
+    def _done(
+        self,
+        job: UploadJob
+    ):
+        job.release()
+        self._pending -= 1
+        if self._finishing and self._pending == 0:
+            self._send.close()
+
 class DownloadManager:
     def __init__(
         self,
-        missing_files: set[BMCLAPIFile],
+        missing_files: FileTable,
         clusters: list['Cluster'],
-        storages: list[CheckStorage]
+        storages: list[CheckStorage],
+        index: FileIndex,
+        journals: Optional[dict[Storage, SyncJournal]] = None
     ):
         self._missing_files = missing_files
         self._clusters = clusters
         self._storages = storages
+        self._index = index
+        self._journals = journals or {}
+        self._uploaders = {
+            storage: StorageUploader(storage.storage, index, self._journals.get(storage.storage))
+            for storage in storages
+        }
         self._pbar = utils.MultiTQDM(
-            total=sum(missing_file.size for missing_file in missing_files),
+            total=missing_files.total_size,
             description="Download",
             unit="B",
             unit_scale=True,
@@ -170,9 +403,17 @@ class DownloadManager:
         )
         self._failed = 0
         self._success = 0
+        self._gave_up = 0
+        self._active = 0
+        self._wakeup = anyio.Event()
+        self._controller = utils.AIMDController(1)
+        # progress bars of the running downloads, reused by position
+        self._bars: list[utils.SubTQDM] = []
+        self._free_bars: list[int] = []
         self._cache_dir = ROOT_PATH / "cache"
+        self._parts_dir = self._cache_dir / "parts"
 
-        self._cache_dir.mkdir(exist_ok=True, parents=True)
+        self._parts_dir.mkdir(exist_ok=True, parents=True)
 
     def update_success(self):
         self._success += 1
@@ -188,100 +429,181 @@ class DownloadManager:
     async def download(self):
         configuration = await self.get_configurations()
         logger.tinfo("download.configuration", source=configuration.source, concurrency=configuration.concurrency)
-        async with anyio.create_task_group() as task_group:
-            queue = Queue()
-            for file in self._missing_files:
-                await queue.put(file)
-            for _ in range(configuration.concurrency):
-                task_group.start_soon(self._download_files, queue, _)
-
-    async def _download_files(
+        self._controller = utils.AIMDController(configuration.concurrency, maximum=cfg.download_max_concurrency)
+        scheduler = DownloadScheduler(self._missing_files)
+        self.clean_parts()
+        async with anyio.create_task_group() as upload_group:
+            for uploader in self._uploaders.values():
+                upload_group.start_soon(uploader.run)
+            try:
+                await self._download(scheduler)
+            finally:
+                for uploader in self._uploaders.values():
+                    uploader.finish()
+        for sub in self._bars:
+            sub.close()
+        if self._gave_up:
+            logger.twarning("download.failed", count=self._gave_up)
+
+    async def _download(
         self,
-        files: Queue[BMCLAPIFile],
-        worker_id: int
+        scheduler: 'DownloadScheduler'
     ):
         async with aiohttp.ClientSession(
             base_url=cfg.base_url,
             headers={
                 "Authorization": f"Bearer {await self._clusters[0].get_token()}",
                 "User-Agent": USER_AGENT,
-            }
+            },
+            connector=aiohttp.TCPConnector(limit=0)
         ) as session:
-            with self._pbar.sub(0, f"Worker {worker_id}", unit="B", unit_scale=True, unit_divisor=1024) as pbar:
-                while files.qsize() != 0:
-                    file = await files.get()
-                    pbar._tqdm.total = file.size
-                    pbar._tqdm.n = 0
-                    pbar._tqdm.set_description_str(file.path)
-                    pbar._tqdm.refresh()
-                    pbar._tqdm.update(0)
-                    await self._download_file(file, session, pbar)
+            async with anyio.create_task_group() as task_group:
+                while True:
+                    limit = self._controller.limit
+                    if self._active < limit:
+                        item = scheduler.next(max(1, limit // 2))
+                        if item is not None:
+                            self._active += 1
+                            task_group.start_soon(self._download_file, *item, session, scheduler)
+                            continue
+                    if self._active == 0 and not scheduler.pending:
+                        break
+                    # wait for a download to finish or a retry to become due
+                    self._wakeup = anyio.Event()
+                    with anyio.move_on_after(scheduler.next_retry_in() if self._active < limit else None):
+                        await self._wakeup.wait()
+
+    def get_part_path(
+        self,
+        hash: str
+    ) -> Path:
+        return self._parts_dir / f"{hash}.part"
+
+    def clean_parts(self):
+        """drops partial downloads of files that are no longer missing"""
+        for part in self._parts_dir.glob("*.part"):
+            if part.stem not in self._missing_files:
+                part.unlink(missing_ok=True)
+
+    def _acquire_bar(self) -> int:
+        if self._free_bars:
+            return heapq.heappop(self._free_bars)
+        self._bars.append(self._pbar.sub(0, f"Worker {len(self._bars)}", unit="B", unit_scale=True, unit_divisor=1024))
+        return len(self._bars) - 1
 
     async def _download_file(
         self,
-        file: BMCLAPIFile,
+        index: int,
+        attempts: int,
         session: aiohttp.ClientSession,
-        pbar: utils.SubTQDM
+        scheduler: 'DownloadScheduler'
     ):
-        last_error = None
-        for _ in range(10):
-            size = 0
+        file = self._missing_files.get_file(index)
+        large = file.size > SMALL_FILE_SIZE
+        scheduler.large_active += large
+        slot = self._acquire_bar()
+        pbar = self._bars[slot]
+        pbar._tqdm.total = file.size
+        pbar._tqdm.n = 0
+        pbar._tqdm.set_description_str(file.path)
+        pbar._tqdm.refresh()
+        pbar._tqdm.update(0)
+        # large files are downloaded into a .part file, whose length is the
+        # checkpoint an interrupted download resumes from
+        resumable = file.size > SPOOL_MEMORY_SIZE
+        part = self.get_part_path(file.hash)
+        size = 0
+        tmp_file: Optional[IO[bytes]] = None
+        try:
             hash = utils.get_hash_obj(file.hash)
-            tmp_file = io.BytesIO()
-            try:
+            if resumable:
+                tmp_file = await anyio.to_thread.run_sync(open_part, part, hash)
+                size = tmp_file.tell()
+            else:
+                tmp_file = tempfile.SpooledTemporaryFile(SPOOL_MEMORY_SIZE, dir=self._cache_dir)
+            self._pbar.update(size)
+            pbar.update(size)
+            if size < file.size:
                 async with session.get(
-                    file.path
+                    file.path,
+                    headers={"Range": f"bytes={size}-"} if size else None
                 ) as resp:
-                    while (data := await resp.content.read(1024 * 1024 * 16)):
-                        tmp_file.write(data)
-                        hash.update(data)
-                        inc = len(data)
-                        size += inc
-                        self._pbar.update(inc)
-                        pbar.update(inc)
-                    if hash.hexdigest() != file.hash or size != file.size:
-                        await anyio.sleep(50)
-                        raise Exception(f"hash mismatch, got {hash.hexdigest()} expected {file.hash}")
-                await self.upload_storage(file, tmp_file, size)
-                self.update_success()
-            except Exception as e:
-                last_error = e
-                self._pbar.update(-size)
-                pbar.update(-size)
+                    resp.raise_for_status()
+                    if size and resp.status != 206:
+                        # the range was ignored, start over
+                        self._pbar.update(-size)
+                        pbar.update(-size)
+                        size = 0
+                        hash = utils.get_hash_obj(file.hash)
+                        await anyio.to_thread.run_sync(tmp_file.truncate, 0)
+
+                    async def read():
+                        nonlocal size
+                        while (data := await resp.content.read(DOWNLOAD_CHUNK_SIZE)):
+                            inc = len(data)
+                            size += inc
+                            self._pbar.update(inc)
+                            pbar.update(inc)
+                            self._controller.report(inc)
+                            yield data
+                    # hashed and written on the hash threads while the next chunk is read
+                    await utils.hash_stream(read(), hash, tmp_file.write)
+            digest = hash.hexdigest()
+            if digest != file.hash or size != file.size:
+                part.unlink(missing_ok=True)
+                raise Exception(f"hash mismatch, got {digest} expected {file.hash}")
+            # only a verified file reaches the storages, which close it once uploaded
+            data, tmp_file = tmp_file, None
+            await self.upload_storage(file, data, size, resumable, part if resumable else None)
+            self._controller.report(success=True)
+            self.update_success()
+        except Exception as e:
+            self._pbar.update(-size)
+            pbar.update(-size)
+            delay = min(DOWNLOAD_RETRY_MAX_DELAY, DOWNLOAD_RETRY_DELAY * 2 ** attempts)
+            throttled = isinstance(e, aiohttp.ClientResponseError) and e.status in (429, 503)
+            if throttled and isinstance(e, aiohttp.ClientResponseError) and e.headers is not None:
+                with contextlib.suppress(ValueError):
+                    delay = max(delay, float(e.headers.get("Retry-After", 0)))
+            self._controller.report(error=True, throttled=throttled)
+            if attempts + 1 >= DOWNLOAD_RETRIES:
+                # only files given up count as failed, retries may still succeed
+                self._gave_up += 1
                 self.update_failed()
-                continue
-            finally:
+                logger.debug_traceback()
+            else:
+                scheduler.retry(index, attempts + 1, delay)
+        finally:
+            if tmp_file is not None:
                 tmp_file.close()
-            return None
-        if last_error is not None:
-            raise last_error
+            scheduler.large_active -= large
+            heapq.heappush(self._free_bars, slot)
+            self._active -= 1
+            self._wakeup.set()
 
     async def upload_storage(
         self,
         file: BMCLAPIFile,
-        data: io.BytesIO,
-        size: int
+        data: IO[bytes],
+        size: int,
+        threaded: bool = True,
+        part: Optional[Path] = None
     ):
-        missing_storage = [
-            storage for storage in self._storages if file in storage.missing_files
+        """
+        Queues the verified file for every storage missing it; waits only
+        while a storage's queue is full. `data` (and the `part` file it
+        was read from) is released once the last storage is done with it.
+        """
+        present = self._index.get(file.hash) or 0
+        uploaders = [
+            uploader for storage, uploader in self._uploaders.items()
+            if file.hash in storage.missing_files and not present & self._index.get_mask(storage.storage)
         ]
-        if len(missing_storage) == 0:
-            return
-        for storage in missing_storage:
-            data.seek(0)
-            retries = 0
-            while 1:
-                try:
-                    await storage.storage.upload_download_file(f"{file.hash[:2]}/{file.hash}", data, size)
-                    break
-                except:
-                    if retries >= 10:
-                        raise
-                    retries += 1
-                    next = 10 * (retries + 1)
-                    logger.twarning("storage.retry_upload", name=storage.storage.name, times=retries, time=next)
-                    logger.traceback()
-                    await anyio.sleep(next)
+        job = UploadJob(file, data, size, threaded, part, len(uploaders))
+        if not uploaders:
+            job.release()
+        for uploader in uploaders:
+            await uploader.put(job)
 
     async def get_configurations(self):
         configurations: list[OpenBMCLAPIConfiguration] = await concurrency.gather(*[
@@ -290,6 +612,113 @@ class DownloadManager:
         # select max concurrency
         return max(configurations, key=lambda x: x.concurrency)
 
+class ReplicationManager:
+    """
+    Fills storages from other storages instead of the center.
+
+    Every file is streamed from the cheapest healthy source holding it
+    straight into the destination, checked against its size (or hash for
+    destinations checked by hash) on the way, and the next source is
+    tried when a copy fails. Each destination copies `upload_concurrency`
+    files at a time.
+    """
+    def __init__(
+        self,
+        storages: StorageManager,
+        journals: Optional[dict[Storage, SyncJournal]] = None
+    ):
+        self._storages = storages
+        self._journals = journals or {}
+        self.success = 0
+        self.failed = 0
+
+    async def fill(
+        self,
+        check_storages: list[CheckStorage]
+    ) -> FileTable:
+        """copies what the checked storages miss from the others, returns the files still missing somewhere"""
+        index = self._storages.index
+        plans: list[tuple[Storage, FileTable]] = []
+        for check_storage in check_storages:
+            others = ~index.get_mask(check_storage.storage)
+            missing_files = check_storage.missing_files
+            plans.append((check_storage.storage, missing_files.take(
+                i for i, hash in enumerate(missing_files.iter_hashes()) if (index.get(hash) or 0) & others
+            )))
+        total = sum(files.total_size for _, files in plans)
+        if total > 0:
+            logger.tinfo("cluster.replicate.files", count=sum(len(files) for _, files in plans), size=units.format_bytes(total))
+            with utils.MultiTQDM(
+                total,
+                description="Replicate",
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024
+            ) as pbar:
+                await concurrency.gather(*(
+                    self.replicate(storage, files, pbar=pbar) for storage, files in plans if len(files) > 0
+                ))
+            if self.failed:
+                logger.twarning("cluster.replicate.failed", count=self.failed)
+        remaining = FileTable()
+        for check_storage in check_storages:
+            mask = index.get_mask(check_storage.storage)
+            missing_files = check_storage.missing_files
+            remaining = remaining.merge(missing_files.take(
+                i for i, hash in enumerate(missing_files.iter_hashes()) if not (index.get(hash) or 0) & mask
+            ))
+        return remaining
+
+    async def replicate(
+        self,
+        destination: Storage,
+        files: FileTable,
+        sources: Optional[list[Storage]] = None,
+        pbar: Optional[utils.MultiTQDM] = None
+    ):
+        """copies `files` into `destination` from `sources`, or else from the storages the index says hold them"""
+        async def works(indices: list[int]):
+            for i in indices:
+                hash = files.get_hash(i)
+                size = files.sizes[i]
+                candidates = sources if sources is not None else self._storages.get_sources(self._storages.index.get(hash) or 0)
+                if await self.copy(hash, size, files.mtimes[i], destination, candidates):
+                    self.success += 1
+                else:
+                    self.failed += 1
+                if pbar is not None:
+                    pbar.update(size)
+        async with anyio.create_task_group() as task_group:
+            for work in utils.split_workload(list(range(len(files))), destination.upload_concurrency):
+                task_group.start_soon(works, work)
+
+    async def copy(
+        self,
+        hash: str,
+        size: int,
+        mtime: int,
+        destination: Storage,
+        sources: list[Storage]
+    ) -> bool:
+        check_hash = destination.check_mode == "hash"
+        for source in sources:
+            if source is destination:
+                continue
+            try:
+                await destination.upload_download_file(
+                    hash,
+                    iter_verified(source.iter_download_file(hash), hash, size, check_hash),
+                    size
+                )
+            except:
+                logger.debug_traceback()
+                continue
+            self._storages.index.add(hash, destination)
+            if destination in self._journals:
+                self._journals[destination].append(hash, size, mtime)
+            return True
+        return False
+
 class ClusterStatus:
     def __init__(self):
         self.dir = ROOT_PATH / "cluster_status"
@@ -486,6 +915,7 @@ class Cluster:
         while not self._stop:
             await self._keepalive_lock.wait()
             try:
+                self._manager.collect_worker_counters(self)
                 current_counter = self.counter.clone()
                 start_time = time.time()
                 res = await self.emit("keep-alive", {
@@ -523,11 +953,8 @@ class Cluster:
             logger.terror("cluster.request_cert.error", id=self.id, name=self.display_name, err=res.err)
             return None
         
-        dir = Path(cfg.get("cert.dir"))
-        dir.mkdir(parents=True, exist_ok=True)
-
-        cert = dir / f"{self.id}.pem"
-        key = dir / f"{self.id}.key"
+        cert, key = self.get_cert_paths()
+        cert.parent.mkdir(parents=True, exist_ok=True)
 
         with open(cert, "w") as c, open(key, "w") as k:
             c.write(res.ack['cert'])
@@ -535,6 +962,17 @@ class Cluster:
 
         return Certificate(CertificateType.CLUSTER, str(cert), str(key))
 
+    def get_cert_paths(self) -> tuple[Path, Path]:
+        dir = Path(cfg.get("cert.dir"))
+        return dir / f"{self.id}.pem", dir / f"{self.id}.key"
+
+    def load_cert(self) -> Optional[Certificate]:
+        """the certificate last saved by `request_cert`, if any"""
+        cert, key = self.get_cert_paths()
+        if not cert.exists() or not key.exists():
+            return None
+        return Certificate(CertificateType.CLUSTER, str(cert), str(key))
+
     async def connect(self):
         if self.sio.connected:
             try:
@@ -579,8 +1017,8 @@ class Cluster:
 
         return SocketEmitResult(err, ack)
         
-    async def get_files(self) -> list[BMCLAPIFile]:
-        results: list[BMCLAPIFile] = []
+    async def get_files(self) -> FileTable:
+        results = FileTable()
         try:
             async with aiohttp.ClientSession(
                 base_url=cfg.base_url,
@@ -598,16 +1036,19 @@ class Cluster:
                     if resp.status == 204: # no new files
                         #logger.tdebug("cluster.get_files.no_new_files", id=self.id)
                         return results
-                    reader = utils.AvroParser(zstd.decompress(await resp.read()))
-                    for _ in range(reader.read_long()):
-                        results.append(BMCLAPIFile(
-                            reader.read_string(),
-                            reader.read_string(),
-                            reader.read_long(),
-                            reader.read_long() / 1000.0,
-                        ))
-                    self._last_modified = max(results, key=lambda x: x.mtime).mtime
-                    logger.tdebug("cluster.get_files", id=self.id, name=self.display_name, count=len(results), size=units.format_bytes(sum([f.size for f in results])), last_modified=units.format_datetime_from_timestamp(self._last_modified))
+                    decoder = utils.FileListDecoder()
+                    columns = utils.FileListBatch()
+                    async for chunk in resp.content.iter_chunked(FILE_LIST_CHUNK_SIZE):
+                        batch = decoder.feed(chunk)
+                        columns.paths += batch.paths
+                        columns.hashes += batch.hashes
+                        columns.sizes += batch.sizes
+                        columns.mtimes += batch.mtimes
+                    decoder.finish()
+                    results = FileTable.from_columns(columns.hashes, columns.sizes, columns.mtimes, columns.paths)
+                    if len(results) > 0:
+                        self._last_modified = results.last_modified
+                    logger.tdebug("cluster.get_files", id=self.id, name=self.display_name, count=len(results), size=units.format_bytes(results.total_size), last_modified=units.format_datetime_from_timestamp(self._last_modified))
         except:
             logger.debug_traceback()
         return results
@@ -737,8 +1178,19 @@ class ClusterManager:
         self._task_group = None
         self._certificate_type: Optional[CertificateType] = None
         self._cluster_name = False
-        self._zero_bytes_files: set[BMCLAPIFile] = set()
         self._zero_bytes_hash: set[str] = set()
+        self._synced = False
+        self._verify_listings = False
+        self._verified_files: dict[Storage, FileTable] = {}
+        self._journals: dict[Storage, SyncJournal] = {}
+        self.manifest = Manifest()
+        self.signatures = SignatureCache()
+        self.hot_files: utils.SpaceSaving[str] = utils.SpaceSaving(HOT_FILES_CAPACITY)
+        self.shared_counters: Optional[SharedCounters] = None
+        # set in worker processes, see `core.workers`
+        self.worker_index: Optional[int] = None
+        self._manifest_mtime: Optional[int] = None
+        self._index_mtime: Optional[int] = None
 
     def add_cluster(
         self,
@@ -768,6 +1220,13 @@ class ClusterManager:
     async def setup(self, task_group: anyio.abc.TaskGroup):
         self._task_group = task_group
 
+        self.load_hot_files()
+        task_group.start_soon(self._save_hot_files)
+
+        # workers must not serve the index of a previous run before the first sync
+        INDEX_PATH.unlink(missing_ok=True)
+        await self.load_manifest()
+
         @utils.event.callback("storage_disable")
         async def _(msg: Any):
             for cluster in self.clusters:
@@ -785,51 +1244,212 @@ class ClusterManager:
 
         await self.storages.setup(task_group)
 
-    async def get_files(self) -> set[BMCLAPIFile]:
+    async def setup_worker(self, task_group: anyio.abc.TaskGroup):
+        """
+        Setup of a worker process: the storages without measures, and the
+        manifest and index the main process saves, reloaded when they change.
+        """
+        self._task_group = task_group
+
+        await self.reload()
+        task_group.start_soon(self._reload)
+
+        await self.storages.setup(task_group, measures=False)
+
+    async def reload(self):
+        """worker processes: load the manifest and index saved since the last call"""
+        manifest_mtime = get_mtime(MANIFEST_PATH)
+        if manifest_mtime != self._manifest_mtime:
+            self._manifest_mtime = manifest_mtime
+            await self.load_manifest()
+        index_mtime = get_mtime(INDEX_PATH)
+        if index_mtime != self._index_mtime:
+            self._index_mtime = index_mtime
+            await anyio.to_thread.run_sync(self.storages.index.load, INDEX_PATH)
+
+    async def _reload(self):
+        while 1:
+            await anyio.sleep(SNAPSHOT_POLL_INTERVAL)
+            try:
+                await self.reload()
+            except:
+                logger.debug_traceback()
+
+    async def load_manifest(self):
+        manifest = await anyio.to_thread.run_sync(Manifest.load)
+        # files of clusters no longer configured must not be served
+        if set(manifest.cursors) != set(self._clusters):
+            return
+        self.manifest = manifest
+        for cluster in self.clusters:
+            cluster._last_modified = manifest.cursors[cluster.id]
+        self.update_zero_bytes_files()
+        logger.tinfo("cluster.manifest.loaded", count=len(manifest.files))
+
+    def update_zero_bytes_files(self):
+        files = self.manifest.files
+        self._zero_bytes_hash = set(files.get_hash(i) for i in files.empty_indices())
+
+    async def get_files(self) -> FileTable:
+        """files changed since the last call, the full list is kept in `manifest`"""
         # 批量获取 files
-        files = set().union(
-            *await concurrency.gather(*[
-                cluster.get_files() for cluster in self.clusters
-            ])
-        )
+        files = FileTable()
+        for cluster_files in await concurrency.gather(*[
+            cluster.get_files() for cluster in self.clusters
+        ]):
+            files = files.merge(cluster_files)
+
+        cursors = {
+            cluster.id: cluster._last_modified for cluster in self.clusters
+        }
+        # nothing new since the last save, the file on disk is current
+        if len(files) > 0 or cursors != self.manifest.cursors:
+            self.manifest.update(files)
+            self.manifest.cursors = cursors
+            try:
+                await anyio.to_thread.run_sync(self.manifest.save)
+            except:
+                logger.debug_traceback()
 
-        # filter 0 bytes
-        zero_bytes = set(filter(lambda x: x.size == 0, files))
-        self._zero_bytes_files = zero_bytes
-        self._zero_bytes_hash = set([f.hash for f in zero_bytes])
-        return files - zero_bytes
+            # filter 0 bytes
+            self.update_zero_bytes_files()
+        return files.exclude(files.empty_indices())
 
     async def sync(self):
         assert self._task_group is not None
 
-        files = await self.get_files()
-        total_size = sum([f.size for f in files])
+        changed_files = await self.get_files()
+        # the first sync and the one verifying listing snapshots check everything
+        check_all = not self._synced or self._verify_listings
+        if check_all:
+            files = self.manifest.files.exclude(self.manifest.files.empty_indices())
+        else:
+            files = changed_files
+        total_size = files.total_size
         if total_size == 0:
             logger.tinfo("cluster.sync.no_files")
             utils.schedule_once(self._task_group, self.sync, 600)
             return
-        last_modified = max(files, key=lambda x: x.mtime).mtime
+        last_modified = files.last_modified
         logger.tinfo("cluster.sync.files", count=len(files), size=units.format_bytes(total_size), last_modified=units.format_datetime_from_timestamp(last_modified))
         
-        check_storages = [CheckStorage(storage) for storage in self.storages.storages]
+        check_storages = [CheckStorage(storage, await self.get_verified_files(storage)) for storage in self.storages.storages]
+        # right after start, trust the listings verified last time
+        listings = {
+            check_storage: await self.load_listing(check_storage.storage)
+            for check_storage in check_storages
+        } if not self._synced else {}
         with utils.MultiTQDM(
             len(check_storages),
             description="Listing files"
         ) as pbar:
-            missing_files: set[BMCLAPIFile] = set().union(
-                *await concurrency.gather(*[
-                    check_storage.get_missing_files(files, pbar) for check_storage in check_storages
-                ])
-            )
+            missing_files = FileTable()
+            for storage_missing_files in await concurrency.gather(*[
+                check_storage.get_missing_files(files, pbar, listings.get(check_storage)) for check_storage in check_storages
+            ]):
+                missing_files = missing_files.merge(storage_missing_files)
+        self._verify_listings = any(listing is not None for listing in listings.values())
+        self.storages.index.update(files, check_storages, check_all)
+        if len(missing_files) > 0:
+            # what another storage already holds is copied from there
+            missing_files = await ReplicationManager(self.storages, self.get_journals()).fill(check_storages)
         if len(missing_files) > 0:
-            logger.tinfo("cluster.sync.missing_files", count=len(missing_files), size=units.format_bytes(sum([f.size for f in missing_files])))
-            download_manager = DownloadManager(missing_files, self.clusters, check_storages)
+            logger.tinfo("cluster.sync.missing_files", count=len(missing_files), size=units.format_bytes(missing_files.total_size))
+            download_manager = DownloadManager(missing_files, self.clusters, check_storages, self.storages.index, self.get_journals())
             await download_manager.download()
         else:
             logger.tinfo("cluster.sync.no_missing_files")
+
+        await self.save_listings(check_storages)
+        self._synced = True
+        # shared counters exist while workers run, they reload the snapshot
+        if self.shared_counters is not None:
+            try:
+                await anyio.to_thread.run_sync(self.storages.index.save, INDEX_PATH)
+            except:
+                logger.debug_traceback()
         
         utils.schedule_once(self._task_group, self.sync, 600)
 
+    async def migrate(
+        self,
+        source: Storage,
+        destinations: list[Storage]
+    ):
+        """
+        Copies every file of `source` the `destinations` lack, without the
+        center; the destinations' journals keep the copies for the next sync.
+        """
+        check_storages = [CheckStorage(storage, await self.get_verified_files(storage)) for storage in destinations]
+        with utils.MultiTQDM(
+            len(destinations) + 1,
+            description="Listing files"
+        ) as pbar:
+            files = await CheckStorage(source).list_files(pbar)
+            pbar.update(1)
+            await concurrency.gather(*(
+                check_storage.get_missing_files(files, pbar) for check_storage in check_storages
+            ))
+        replication = ReplicationManager(self.storages, self.get_journals())
+        total = sum(check_storage.missing_files.total_size for check_storage in check_storages)
+        for check_storage in check_storages:
+            logger.tinfo("cluster.migrate.missing_files", name=check_storage.storage.name, count=len(check_storage.missing_files), size=units.format_bytes(check_storage.missing_files.total_size))
+        with utils.MultiTQDM(
+            total,
+            description="Migrate",
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024
+        ) as pbar:
+            await concurrency.gather(*(
+                replication.replicate(check_storage.storage, check_storage.missing_files, [source], pbar)
+                for check_storage in check_storages
+            ))
+        for journal in self.get_journals().values():
+            journal.close()
+        logger.tinfo("cluster.migrate.done", success=replication.success, failed=replication.failed)
+
+    def get_journals(self) -> dict[Storage, SyncJournal]:
+        for storage in self.storages.storages:
+            if storage not in self._journals:
+                self._journals[storage] = SyncJournal(get_storage_journal_path(storage))
+        return self._journals
+
+    async def load_listing(self, storage: Storage) -> Optional[FileTable]:
+        """the saved listing of a storage plus the files committed to it since"""
+        return await anyio.to_thread.run_sync(read_listing, get_storage_listing_path(storage), self.get_journals()[storage])
+
+    async def get_verified_files(self, storage: Storage) -> FileTable:
+        """files of a hash checked storage whose content was verified, see `CheckStorage`"""
+        if storage not in self._verified_files:
+            self._verified_files[storage] = await anyio.to_thread.run_sync(load_listing, get_storage_verified_path(storage)) or FileTable()
+        return self._verified_files[storage]
+
+    async def save_listings(self, check_storages: list[CheckStorage]):
+        index = self.storages.index
+        for check_storage in check_storages:
+            if check_storage.storage.check_mode == "hash":
+                self._verified_files[check_storage.storage] = check_storage.verified
+                try:
+                    await anyio.to_thread.run_sync(save_listing, get_storage_verified_path(check_storage.storage), check_storage.verified)
+                except:
+                    logger.debug_traceback()
+            mask = index.get_mask(check_storage.storage)
+            missing_files = check_storage.missing_files
+            # files downloaded into the storage during this sync
+            downloaded = missing_files.take(
+                i for i, hash in enumerate(missing_files.iter_hashes()) if (index.get(hash) or 0) & mask
+            )
+            try:
+                await anyio.to_thread.run_sync(
+                    write_listing,
+                    get_storage_listing_path(check_storage.storage),
+                    check_storage.listing.merge(downloaded),
+                    self.get_journals()[check_storage.storage]
+                )
+            except:
+                logger.debug_traceback()
+
     async def serve(self):
         async with anyio.create_task_group() as task_group:
             for cluster in self.clusters:
@@ -838,6 +1458,10 @@ class ClusterManager:
     async def stop(self):
         for cluster in self.clusters:
             await cluster.stop_serve()
+        try:
+            self.save_hot_files()
+        except:
+            logger.debug_traceback()
 
     async def load_certificates(self):
         cert_type = utils.get_certificate_type()
@@ -853,6 +1477,14 @@ class ClusterManager:
         
         return certificates
 
+    def load_saved_certificates(self):
+        if utils.get_certificate_type() != abc.CertificateType.CLUSTER:
+            return []
+        return [
+            cert for cert in (cluster.load_cert() for cluster in self.clusters)
+            if cert is not None
+        ]
+
     async def fetch_cluster_name(self):
         assert self._task_group is not None
         try:
@@ -877,27 +1509,85 @@ class ClusterManager:
         self._cluster_name = False
         await self.fetch_cluster_name()
 
-    def hit(self, cluster_id: str, bytes: int):
-        self._clusters[cluster_id].counter.hits += 1
-        self._clusters[cluster_id].counter.bytes += bytes
+    def hit(self, cluster_id: str, bytes: int, hash: str):
+        if self.worker_index is not None and self.shared_counters is not None:
+            self.shared_counters.add(self.worker_index, cluster_id, bytes)
+        else:
+            self._clusters[cluster_id].counter.hits += 1
+            self._clusters[cluster_id].counter.bytes += bytes
+        self.hot_files.add(hash, bytes)
+
+    def collect_worker_counters(self, cluster: 'Cluster'):
+        """move hits served by worker processes into `cluster.counter`"""
+        if self.worker_index is not None or self.shared_counters is None:
+            return
+        hits, bytes = self.shared_counters.collect(cluster.id)
+        cluster.counter.hits += hits
+        cluster.counter.bytes += bytes
+
+    def load_hot_files(self):
+        if not HOT_FILES_PATH.exists():
+            return
+        try:
+            data = json.loads(HOT_FILES_PATH.read_text())
+            self.hot_files.load([
+                (item["hash"], item["hits"], item["error"], item["bytes"])
+                for item in data["files"]
+            ], data["total"])
+        except:
+            logger.debug_traceback()
+
+    def save_hot_files(self):
+        HOT_FILES_PATH.parent.mkdir(parents=True, exist_ok=True)
+        HOT_FILES_PATH.write_text(json.dumps({
+            "total": self.hot_files.total,
+            "files": self.get_hot_files(),
+        }))
+
+    def get_hot_files(self, limit: Optional[int] = None) -> list[dict[str, Any]]:
+        return [
+            {
+                "hash": hash,
+                "hits": hits,
+                "error": error,
+                "bytes": bytes,
+            } for hash, hits, error, bytes in self.hot_files.top(limit)
+        ]
+
+    async def _save_hot_files(self):
+        while 1:
+            await anyio.sleep(300)
+            try:
+                self.save_hot_files()
+            except:
+                logger.debug_traceback()
 
     async def get_response_file(self, hash: str) -> ResponseFile:
         if hash in self._zero_bytes_hash:
             return ResponseFile(
                 0
             )
-        storage = self.storages.get_weight_storage()
-        if storage is None:
+        mask = self.storages.index.get(hash)
+        if mask == 0:
+            return ResponseFileNotFound()
+        storages = self.storages.get_storages(mask)
+        if not storages:
             logger.twarning("cluster.get_response_file.no_storage")
-            return ResponseFile(
-                0
-            )
-        try:
-            return await storage.get_response_file(hash)
-        except:
-            return ResponseFile(
-                0
-            )
+            return ResponseFileNotFound()
+        for storage in storages:
+            start = time.monotonic()
+            try:
+                file = await storage.get_response_file(hash)
+            except:
+                self.storages.report(storage, False, time.monotonic() - start)
+                logger.debug_traceback()
+                continue
+            self.storages.report(storage, True, time.monotonic() - start)
+            if isinstance(file, ResponseFileNotFound):
+                self.storages.index.discard(hash, storage)
+                continue
+            return file
+        return ResponseFileNotFound()
     
     async def get_measure_file(self, size: int) -> Optional[ResponseFile]:
         if not self.storages._online_storages:
@@ -907,10 +1597,74 @@ class ClusterManager:
             )
         storage = self.storages._online_storages[0]
         try:
-            return await storage.get_file(f"measure/{size}")
+            return await storage.fetch_file(f"measure/{size}")
         except:
             return None
     
+def read_listing(path: Path, journal: SyncJournal) -> Optional[FileTable]:
+    listing = load_listing(path)
+    if listing is None:
+        return None
+    return listing.merge(journal.load())
+
+def write_listing(path: Path, files: FileTable, journal: SyncJournal):
+    # the journal only goes once the listing holding its files is on disk
+    save_listing(path, files)
+    journal.clear()
+
+def get_mtime(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def get_storage_listing_path(storage: Storage):
+    return get_listing_path(storage.type, storage.name, str(storage.path))
+
+def get_storage_verified_path(storage: Storage) -> Path:
+    path = get_storage_listing_path(storage)
+    return path.with_name(f"{path.stem}.verified{path.suffix}")
+
+def get_storage_journal_path(storage: Storage) -> Path:
+    path = get_storage_listing_path(storage)
+    return path.with_name(f"{path.stem}.journal")
+
+def open_part(
+    path: Path,
+    hash: Any
+) -> IO[bytes]:
+    """opens a partial download for appending, feeding what it holds to `hash`, blocking"""
+    file = open(path, "a+b")
+    file.seek(0)
+    while (data := file.read(utils.HASH_CHUNK_SIZE)):
+        hash.update(data)
+    return file
+
+FILE_LIST_CHUNK_SIZE = 1024 * 64
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# files above this size take the large lane of `DownloadScheduler`
+SMALL_FILE_SIZE = 1024 * 1024 * 4
+DOWNLOAD_RETRIES = 10
+DOWNLOAD_RETRY_DELAY = 5
+DOWNLOAD_RETRY_MAX_DELAY = 300
+UPLOAD_QUEUE_SIZE = 16
+UPLOAD_RETRIES = 10
+UPLOAD_RETRY_DELAY = 10
+SPOOL_MEMORY_SIZE = 1024 * 1024 * 4
+HOT_FILES_CAPACITY = 1024
+# how often workers look for a newer manifest and index
+SNAPSHOT_POLL_INTERVAL = 5
+HOT_FILES_PATH = ROOT_PATH / "cache" / "hot_files.json"
+
+def get_sign_expires(
+    e: str
+) -> float:
+    """`e` is a base36 millisecond timestamp, returns seconds (0 if invalid)"""
+    try:
+        return int(e, 36) / 1000.0
+    except ValueError:
+        return 0
+
 status = ClusterStatus()
 
 if cfg.concurrency_enable_cluster:
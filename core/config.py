@@ -88,6 +88,10 @@ class Config:
     def access_log(self):
         return self.get("advanced.access_log") or False
     
+    @property
+    def access_log_format(self) -> str:
+        return self.get("advanced.access_log_format") or "text"
+
     @property
     def storage_measure(self) -> bool:
         return self.get("advanced.storage_measure") or False
@@ -108,6 +112,37 @@ class Config:
     def bridge_web_application(self) -> bool:
         return self.get("advanced.bridge_web_application") or False
 
+    @property
+    def web_mode(self) -> str:
+        """
+        forward (loopback relay to uvicorn, the default), bridge, or the
+        opt-in inprocess, which drives uvicorn's internal HTTP protocol
+        directly over the public stream
+        """
+        if self.bridge_web_application:
+            return "bridge"
+        return self.get("advanced.web_mode") or "forward"
+
+    @property
+    def tls_session_rotation(self) -> float:
+        return units.parse_time_units(self.get("advanced.tls_session_rotation") or "12h")
+
+    @property
+    def workers(self) -> int:
+        return int(self.get("advanced.workers") or 0)
+
+    @property
+    def download_max_concurrency(self) -> int:
+        return int(self.get("advanced.download_max_concurrency") or 64)
+
+    @property
+    def hash_workers(self) -> int:
+        return int(self.get("advanced.hash_workers") or os.cpu_count() or 1)
+
+    @property
+    def object_cache_size(self) -> float:
+        return units.parse_number_units(str(self.get("advanced.object_cache_size") or "512M"))
+
 API_VERSION = "1.14.0"
 VERSION = "4.0.17"
 PROJECT = "PythonOpenBMCLAPI"
@@ -118,6 +153,7 @@ DEFAULT_CONFIG = {
     "advanced.locale": "zh_cn",
     "advanced.debug": False,
     "advanced.access_log": False,
+    "advanced.access_log_format": "text",
     "advanced.host": "",
     "advanced.concurrency_enable_cluster": False,
     "advanced.cluster_up_failed_times": 90,
@@ -126,6 +162,12 @@ DEFAULT_CONFIG = {
     "advanced.bd_url": "https://bd.bangbang93.com",
     "advanced.storage_measure": False,
     "advanced.bridge_web_application": False,
+    "advanced.web_mode": "forward",
+    "advanced.tls_session_rotation": "12h",
+    "advanced.workers": 0,
+    "advanced.object_cache_size": "512M",
+    "advanced.hash_workers": 0,
+    "advanced.download_max_concurrency": 64,
     "web.port": 6543,
     "web.public_port": 6543,
     "web.proxy": False,
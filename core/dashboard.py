@@ -9,7 +9,12 @@ import fastapi
 import psutil
 from fastapi.staticfiles import StaticFiles
 
+from .cluster import HOT_FILES_CAPACITY, ClusterManager
 from .config import ROOT_PATH
+from .logger import access_logger
+from .storage.abc import single_flight
+from .storage.cache import cache
+from . import web
 from .web import query_per_second_statistics
 from .utils import scheduler
 from tianxiu2b2t.utils import runtime
@@ -100,6 +105,7 @@ systeminfo = SystemInfo()
 async def setup(
     app: fastapi.FastAPI,
     task_group: anyio.abc.TaskGroup,
+    clusters: ClusterManager,
 ):
     #if not DEBUG:
     #    return
@@ -123,11 +129,48 @@ async def setup(
         if interval is None:
             return query_per_second_statistics.get_all()
         return query_per_second_statistics.merge_data(interval)
+
+    @app.get("/api/qps/details")
+    async def _(interval: int = 5):
+        return query_per_second_statistics.get_details(interval)
     
     @app.get("/api/system")
     async def _():
         return systeminfo.get_info()
 
+    @app.get("/api/cache")
+    async def _():
+        return cache.get_statistics()
+
+    @app.get("/api/storage")
+    async def _():
+        return {
+            "single_flight": single_flight.get_statistics(),
+            "storages": clusters.storages.get_statistics(),
+            "index": {
+                "ready": clusters.storages.index.ready,
+                "files": len(clusters.storages.index),
+            },
+        }
+
+    @app.get("/api/hot_files")
+    async def _(limit: int = fastapi.Query(100, ge=1, le=HOT_FILES_CAPACITY)):
+        return clusters.get_hot_files(limit)
+
+    @app.get("/api/access_log")
+    async def _():
+        return access_logger.get_statistics()
+
+    @app.get("/api/tls")
+    async def _():
+        if web.tls_listener is None:
+            return None
+        return web.tls_listener.get_statistics()
+
+    @app.get("/api/signature")
+    async def _():
+        return clusters.signatures.get_statistics()
+
     @app.get("/")
     @app.get("/{page}")
     @app.get("/{page}/{pages}")
@@ -1,9 +1,16 @@
+from collections import deque
+import datetime
+import json
 import logging
+from pathlib import Path
 import sys
+import threading
 import traceback
+from typing import Optional
 from loguru import logger as Logger
+from tianxiu2b2t import units
 from .locale import t
-from .config import DEBUG
+from .config import DEBUG, cfg
 
 LOGGER_FORMAT = "<green>[{time:YYYY-MM-DD HH:mm:ss}]</green> <level>[{level}] <yellow>[{name}:{function}:{line}]</yellow>: {message}</level>"
 
@@ -79,6 +86,147 @@ class Loglogger:
 
 logger = Loglogger()
 
+# (timestamp, address, host, method, path, status, total_time ns, user agent)
+AccessRecord = tuple[float, str, str, str, str, int, int, str]
+
+class AccessLogger:
+    """
+    Access log pipeline kept off the request path.
+
+    `log` only appends a tuple to a bounded deque (append / popleft are
+    atomic, so no lock is taken); a daemon thread drains it in batches and
+    formats them either as the usual translated line or as JSON lines in
+    `logs/access/`. When the buffer is full the record is dropped and
+    counted instead of blocking the caller.
+    """
+    def __init__(
+        self,
+        capacity: int = 65536,
+        batch_size: int = 1024,
+        interval: float = 1,
+    ):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self.format = "text"
+        self.dropped = 0
+        self.written = 0
+        self._reported_dropped = 0
+        self._buffer: deque[AccessRecord] = deque()
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._file_date = None
+
+    def log(
+        self,
+        *record
+    ):
+        if len(self._buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        self._buffer.append(record) # type: ignore
+        if not self._running:
+            self.flush()
+        elif len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._running:
+            return
+        self.format = cfg.access_log_format
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="AccessLogger", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def get_statistics(self):
+        return {
+            "format": self.format,
+            "pending": len(self._buffer),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except:
+                logger.debug_traceback()
+
+    def flush(self):
+        while self._buffer:
+            batch: list[AccessRecord] = []
+            while self._buffer and len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+            if self.format == "jsonl":
+                self._write_jsonl(batch)
+            else:
+                self._write_text(batch)
+            self.written += len(batch)
+        if self.dropped != self._reported_dropped:
+            logger.twarning("web.access_log.dropped", count=self.dropped - self._reported_dropped)
+            self._reported_dropped = self.dropped
+
+    def _write_text(self, batch: list[AccessRecord]):
+        for _, address, host, method, path, status, total_time, user_agent in batch:
+            logger.tinfo(
+                "web.access_log",
+                host=host,
+                method=method.ljust(7),
+                path=path,
+                status=status,
+                total_time=units.format_count_time(total_time, 4).rjust(14),
+                user_agent=user_agent,
+                address=address.ljust(16),
+            )
+
+    def _write_jsonl(self, batch: list[AccessRecord]):
+        file = self._get_file()
+        file.write("".join(
+            json.dumps({
+                "time": timestamp,
+                "address": address,
+                "host": host,
+                "method": method,
+                "path": path,
+                "status": status,
+                "total_time": total_time,
+                "user_agent": user_agent,
+            }, separators=(",", ":")) + "\n"
+            for timestamp, address, host, method, path, status, total_time, user_agent in batch
+        ))
+        file.flush()
+
+    def _get_file(self):
+        date = datetime.date.today()
+        if self._file is None or self._file_date != date:
+            if self._file is not None:
+                self._file.close()
+            path = Path(f"./logs/access/{date.isoformat()}.jsonl")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(path, "a", encoding="utf-8")
+            self._file_date = date
+        return self._file
+
+access_logger = AccessLogger()
+
 
 def _log(*values):
     data = []
@@ -127,4 +275,4 @@ logging.basicConfig(
 
 
 
-__all__ = ["logger"]
\ No newline at end of file
+__all__ = ["logger", "access_logger"]
\ No newline at end of file
@@ -0,0 +1,604 @@
+from array import array
+import bisect
+import hashlib
+import itertools
+import os
+from pathlib import Path
+import struct
+import sys
+from typing import Iterable, Iterator, Optional
+
+from .abc import BMCLAPIFile
+from .config import ROOT_PATH
+from .logger import logger
+
+MANIFEST_MAGIC = b"OBMF"
+LISTING_MAGIC = b"OBML"
+INDEX_MAGIC = b"OBMI"
+VERSION = 2
+MANIFEST_PATH = ROOT_PATH / "cache" / "manifest.bin"
+LISTINGS_DIR = ROOT_PATH / "cache" / "listings"
+INDEX_PATH = ROOT_PATH / "cache" / "index.bin"
+
+HEADER = struct.Struct("<4sBI")
+CURSOR = struct.Struct("<Hq")
+COUNT = struct.Struct("<I")
+# digest length, then the digest zero padded to the widest (sha1) digest
+DIGEST_SIZE = 20
+KEY_SIZE = DIGEST_SIZE + 1
+SHA1_PREFIX = bytes((20, ))
+JOURNAL_RECORD = struct.Struct(f"<{KEY_SIZE}sqq")
+
+def get_key(
+    hash: str
+) -> bytes:
+    """fixed width sort key of a hex digest, raises ValueError if it is none"""
+    digest = bytes.fromhex(hash)
+    if not digest or len(digest) > DIGEST_SIZE:
+        raise ValueError(f"not a digest: {hash}")
+    return bytes((len(digest), )) + digest.ljust(DIGEST_SIZE, b"\0")
+
+class FileTable:
+    """
+    A set of files stored column by column and sorted by digest.
+
+    `keys` holds one `KEY_SIZE` record per file, `sizes`, `mtimes` (ms)
+    and `path_lengths` are arrays and `paths` is one utf-8 blob, which
+    is a fraction of the memory of one `BMCLAPIFile` per file and can be
+    written to disk as is. Lookups are binary searches; `merge` and
+    `difference` walk both tables in order and compare runs of equal
+    records a block at a time, so tables that mostly agree are compared
+    at memcmp speed.
+
+    Storage listings use the same type with the paths left empty.
+    """
+    def __init__(
+        self,
+        keys: bytes = b"",
+        sizes: Optional[array] = None,
+        mtimes: Optional[array] = None,
+        path_lengths: Optional[array] = None,
+        paths: bytes = b""
+    ):
+        self.keys = keys
+        self.sizes = sizes if sizes is not None else array("q")
+        self.mtimes = mtimes if mtimes is not None else array("q")
+        self.path_lengths = path_lengths if path_lengths is not None else array("I")
+        self.paths = paths
+        self._offsets: Optional[array] = None
+
+    @classmethod
+    def from_columns(
+        cls,
+        hashes: list[str],
+        sizes: list[int],
+        mtimes: Optional[list[int]] = None,
+        paths: Optional[list[str]] = None
+    ) -> 'FileTable':
+        """build a table from unsorted columns, names that are not digests are skipped and the last duplicate wins"""
+        keys = _get_keys(hashes)
+        indices: list[int] = []
+        records: list[bytes] = []
+        last = b""
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            key = keys[i]
+            if not key:
+                continue
+            if key == last:
+                indices[-1] = i
+                continue
+            last = key
+            records.append(key)
+            indices.append(i)
+        count = len(indices)
+        table = cls(
+            b"".join(records),
+            array("q", map(sizes.__getitem__, indices)),
+            array("q", map(mtimes.__getitem__, indices)) if mtimes is not None else array("q", bytes(8 * count)),
+        )
+        if paths is not None:
+            encoded = [paths[i].encode("utf-8") for i in indices]
+            table.path_lengths = array("I", map(len, encoded))
+            table.paths = b"".join(encoded)
+        else:
+            table.path_lengths = array("I", bytes(4 * count))
+        return table
+
+    @classmethod
+    def from_files(
+        cls,
+        files: Iterable[BMCLAPIFile]
+    ) -> 'FileTable':
+        files = list(files)
+        return cls.from_columns(
+            [file.hash for file in files],
+            [file.size for file in files],
+            [int(file.mtime * 1000) for file in files],
+            [file.path for file in files]
+        )
+
+    def __len__(self) -> int:
+        return len(self.keys) // KEY_SIZE
+
+    def __iter__(self) -> Iterator[BMCLAPIFile]:
+        keys, paths = self.keys, self.paths
+        offset = 0
+        for i, (size, mtime, length) in enumerate(zip(self.sizes, self.mtimes, self.path_lengths)):
+            key = keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]
+            yield BMCLAPIFile(paths[offset:offset + length].decode("utf-8"), key[1:key[0] + 1].hex(), size, mtime / 1000.0)
+            offset += length
+
+    def __contains__(
+        self,
+        hash: str
+    ) -> bool:
+        return self.find(hash) != -1
+
+    def key(
+        self,
+        index: int
+    ) -> bytes:
+        return self.keys[index * KEY_SIZE:(index + 1) * KEY_SIZE]
+
+    def get_hash(
+        self,
+        index: int
+    ) -> str:
+        key = self.key(index)
+        return key[1:key[0] + 1].hex()
+
+    def iter_hashes(self) -> Iterator[str]:
+        keys = self.keys
+        for i in range(0, len(keys), KEY_SIZE):
+            yield keys[i + 1:i + keys[i] + 1].hex()
+
+    def get_file(
+        self,
+        index: int
+    ) -> BMCLAPIFile:
+        offsets = self._get_offsets()
+        return BMCLAPIFile(
+            self.paths[offsets[index]:offsets[index + 1]].decode("utf-8"),
+            self.get_hash(index),
+            self.sizes[index],
+            self.mtimes[index] / 1000.0
+        )
+
+    def find(
+        self,
+        hash: str
+    ) -> int:
+        """position of `hash`, -1 if it is not in the table"""
+        try:
+            key = get_key(hash)
+        except ValueError:
+            return -1
+        index = bisect.bisect_left(range(len(self)), key, key=self.key)
+        if index < len(self) and self.key(index) == key:
+            return index
+        return -1
+
+    def get(
+        self,
+        hash: str
+    ) -> Optional[BMCLAPIFile]:
+        index = self.find(hash)
+        return self.get_file(index) if index != -1 else None
+
+    @property
+    def total_size(self) -> int:
+        return sum(self.sizes)
+
+    @property
+    def last_modified(self) -> float:
+        return max(self.mtimes, default=0) / 1000.0
+
+    def empty_indices(self) -> list[int]:
+        """positions of the zero byte files"""
+        indices: list[int] = []
+        index = -1
+        try:
+            while True:
+                index = self.sizes.index(0, index + 1)
+                indices.append(index)
+        except ValueError:
+            return indices
+
+    def take(
+        self,
+        indices: Iterable[int]
+    ) -> 'FileTable':
+        return FileTable._concat([(self, i, i + 1) for i in indices])
+
+    def exclude(
+        self,
+        indices: Iterable[int]
+    ) -> 'FileTable':
+        ranges: list[tuple[FileTable, int, int]] = []
+        start = 0
+        for i in indices:
+            ranges.append((self, start, i))
+            start = i + 1
+        ranges.append((self, start, len(self)))
+        return FileTable._concat(ranges)
+
+    def merge(
+        self,
+        other: 'FileTable'
+    ) -> 'FileTable':
+        """union of both tables, files of `other` replace those with the same digest"""
+        if not len(self):
+            return other
+        if not len(other):
+            return self
+        ranges: list[tuple[FileTable, int, int]] = []
+        count, other_count = len(self), len(other)
+        i, j = 0, 0
+        while j < other_count:
+            key = other.key(j)
+            p = bisect.bisect_left(range(count), key, lo=i, key=self.key)
+            ranges.append((self, i, p))
+            if p < count and self.key(p) == key:
+                n = _common_run(self, p, other, j)
+                ranges.append((other, j, j + n))
+                i, j = p + n, j + n
+                continue
+            if p == count:
+                ranges.append((other, j, other_count))
+                i, j = p, other_count
+                break
+            q = bisect.bisect_left(range(other_count), self.key(p), lo=j + 1, key=other.key)
+            ranges.append((other, j, q))
+            i, j = p, q
+        ranges.append((self, i, count))
+        return FileTable._concat(ranges)
+
+    def difference(
+        self,
+        other: 'FileTable',
+        sizes: bool = True,
+        mtimes: bool = False
+    ) -> 'FileTable':
+        """files of this table that `other` lacks, or has with another size / mtime when asked to compare those"""
+        ranges: list[tuple[FileTable, int, int]] = []
+        count, other_count = len(self), len(other)
+        i, j = 0, 0
+        while i < count:
+            if j >= other_count:
+                ranges.append((self, i, count))
+                break
+            key = self.key(i)
+            q = bisect.bisect_left(range(other_count), key, lo=j, key=other.key)
+            if q < other_count and other.key(q) == key:
+                n = _common_run(self, i, other, q)
+                if (
+                    sizes and self.sizes[i:i + n] != other.sizes[q:q + n] or
+                    mtimes and self.mtimes[i:i + n] != other.mtimes[q:q + n]
+                ):
+                    for k in range(n):
+                        if (
+                            sizes and self.sizes[i + k] != other.sizes[q + k] or
+                            mtimes and self.mtimes[i + k] != other.mtimes[q + k]
+                        ):
+                            ranges.append((self, i + k, i + k + 1))
+                i, j = i + n, q + n
+                continue
+            if q == other_count:
+                ranges.append((self, i, count))
+                break
+            p = bisect.bisect_left(range(count), other.key(q), lo=i + 1, key=self.key)
+            ranges.append((self, i, p))
+            i, j = p, q
+        return FileTable._concat(ranges)
+
+    def _get_offsets(self) -> array:
+        if self._offsets is None:
+            self._offsets = array("Q", itertools.accumulate(self.path_lengths, initial=0))
+        return self._offsets
+
+    @staticmethod
+    def _concat(
+        ranges: list[tuple['FileTable', int, int]]
+    ) -> 'FileTable':
+        keys: list[bytes] = []
+        sizes, mtimes, path_lengths = array("q"), array("q"), array("I")
+        paths: list[bytes] = []
+        for table, start, stop in ranges:
+            if start >= stop:
+                continue
+            keys.append(table.keys[start * KEY_SIZE:stop * KEY_SIZE])
+            sizes += table.sizes[start:stop]
+            mtimes += table.mtimes[start:stop]
+            path_lengths += table.path_lengths[start:stop]
+            if table.paths:
+                offsets = table._get_offsets()
+                paths.append(table.paths[offsets[start]:offsets[stop]])
+        return FileTable(b"".join(keys), sizes, mtimes, path_lengths, b"".join(paths))
+
+    def dumps(self) -> bytes:
+        return b"".join((
+            COUNT.pack(len(self)),
+            self.keys,
+            _to_le(self.sizes),
+            _to_le(self.mtimes),
+            _to_le(self.path_lengths),
+            self.paths
+        ))
+
+    @classmethod
+    def loads(
+        cls,
+        view: memoryview,
+        offset: int = 0
+    ) -> tuple['FileTable', int]:
+        """the table at `offset` and the offset after it"""
+        count, = COUNT.unpack_from(view, offset)
+        offset += COUNT.size
+        keys = bytes(view[offset:offset + count * KEY_SIZE])
+        offset += count * KEY_SIZE
+        sizes = _from_le("q", view[offset:offset + count * 8])
+        offset += count * 8
+        mtimes = _from_le("q", view[offset:offset + count * 8])
+        offset += count * 8
+        path_lengths = _from_le("I", view[offset:offset + count * 4])
+        offset += count * 4
+        length = sum(path_lengths)
+        paths = bytes(view[offset:offset + length])
+        offset += length
+        if len(keys) != count * KEY_SIZE or len(paths) != length:
+            raise ValueError("file table truncated")
+        return cls(keys, sizes, mtimes, path_lengths, paths), offset
+
+def _get_keys(
+    hashes: list[str]
+) -> list[bytes]:
+    """keys of `hashes`, b"" for names that are not digests"""
+    fromhex = bytes.fromhex
+    try:
+        # sha1 fast path
+        return [SHA1_PREFIX + fromhex(hash) if len(hash) == 40 else get_key(hash) for hash in hashes]
+    except ValueError:
+        ...
+    keys: list[bytes] = []
+    for hash in hashes:
+        try:
+            keys.append(get_key(hash))
+        except ValueError:
+            keys.append(b"")
+    return keys
+
+def _common_run(
+    a: FileTable,
+    i: int,
+    b: FileTable,
+    j: int
+) -> int:
+    """length of the run of equal keys at `a[i]` and `b[j]`, galloping over whole blocks"""
+    a_keys, b_keys = a.keys, b.keys
+    limit = min(len(a) - i, len(b) - j)
+    n, step = 1, 1
+    while step:
+        m = min(step, limit - n)
+        if m > 0 and a_keys[(i + n) * KEY_SIZE:(i + n + m) * KEY_SIZE] == b_keys[(j + n) * KEY_SIZE:(j + n + m) * KEY_SIZE]:
+            n += m
+            step *= 2
+        else:
+            step //= 2
+    return n
+
+def _to_le(
+    values: array
+) -> bytes:
+    if sys.byteorder == "little":
+        return values.tobytes()
+    values = array(values.typecode, values)
+    values.byteswap()
+    return values.tobytes()
+
+def _from_le(
+    typecode: str,
+    data: memoryview
+) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+class Manifest:
+    """
+    Every file the clusters have announced, plus the per-cluster
+    `lastModified` cursor they were fetched up to.
+
+    Persisted in a compact binary format so a restart only asks the
+    center for the files changed since the cursors.
+
+    Layout (little endian): magic, version, cursor count, then
+    `(id length, cursor ms, id)` per cluster, then the `FileTable` columns.
+    """
+    def __init__(
+        self
+    ):
+        self.files = FileTable()
+        self.cursors: dict[str, float] = {}
+
+    def update(
+        self,
+        files: FileTable
+    ):
+        self.files = self.files.merge(files)
+
+    def dumps(self) -> bytes:
+        buf = bytearray(HEADER.pack(MANIFEST_MAGIC, VERSION, len(self.cursors)))
+        for id, cursor in self.cursors.items():
+            raw_id = id.encode("utf-8")
+            buf += CURSOR.pack(len(raw_id), int(cursor * 1000))
+            buf += raw_id
+        buf += self.files.dumps()
+        return bytes(buf)
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'Manifest':
+        manifest = cls()
+        view = memoryview(data)
+        magic, version, count = HEADER.unpack_from(view, 0)
+        if magic != MANIFEST_MAGIC or version != VERSION:
+            raise ValueError("unknown manifest format")
+        offset = HEADER.size
+        for _ in range(count):
+            length, cursor = CURSOR.unpack_from(view, offset)
+            offset += CURSOR.size
+            manifest.cursors[bytes(view[offset:offset + length]).decode("utf-8")] = cursor / 1000.0
+            offset += length
+        manifest.files, _ = FileTable.loads(view, offset)
+        return manifest
+
+    def save(self, path: Path = MANIFEST_PATH):
+        write_atomic(path, self.dumps())
+
+    @classmethod
+    def load(cls, path: Path = MANIFEST_PATH) -> 'Manifest':
+        if not path.exists():
+            return cls()
+        try:
+            return cls.loads(path.read_bytes())
+        except:
+            logger.debug_traceback()
+            return cls()
+
+def get_listing_path(
+    type: str,
+    name: str,
+    path: str
+) -> Path:
+    key = hashlib.sha1(f"{type}:{name}:{path}".encode("utf-8")).hexdigest()[:16]
+    return LISTINGS_DIR / f"{key}.bin"
+
+def save_listing(
+    path: Path,
+    files: FileTable
+):
+    """the files last seen in a storage's download dir"""
+    write_atomic(path, HEADER.pack(LISTING_MAGIC, VERSION, 0) + files.dumps())
+
+def load_listing(
+    path: Path
+) -> Optional[FileTable]:
+    if not path.exists():
+        return None
+    try:
+        view = memoryview(path.read_bytes())
+        magic, version, _ = HEADER.unpack_from(view, 0)
+        if magic != LISTING_MAGIC or version != VERSION:
+            return None
+        files, _ = FileTable.loads(view, HEADER.size)
+        return files
+    except:
+        logger.debug_traceback()
+        return None
+
+def save_index(
+    path: Path,
+    files: dict[str, int],
+    storages: int
+):
+    """
+    Snapshot of a `FileIndex` for the worker processes: the storage count,
+    the file count, one mask per file and the hashes separated by newlines.
+    """
+    masks = array("q", files.values())
+    write_atomic(path, b"".join((
+        HEADER.pack(INDEX_MAGIC, VERSION, storages),
+        COUNT.pack(len(masks)),
+        _to_le(masks),
+        "\n".join(files).encode("utf-8")
+    )))
+
+def load_index(
+    path: Path,
+    storages: int
+) -> Optional[dict[str, int]]:
+    """the files of a snapshot, None if there is none for this storage configuration"""
+    if not path.exists():
+        return None
+    try:
+        view = memoryview(path.read_bytes())
+        magic, version, count = HEADER.unpack_from(view, 0)
+        if magic != INDEX_MAGIC or version != VERSION or count != storages:
+            return None
+        offset = HEADER.size
+        count, = COUNT.unpack_from(view, offset)
+        offset += COUNT.size
+        masks = _from_le("q", view[offset:offset + count * 8])
+        hashes = bytes(view[offset + count * 8:]).decode("utf-8").split("\n") if count else []
+        if len(masks) != count or len(hashes) != count:
+            raise ValueError("index truncated")
+        return dict(zip(hashes, masks))
+    except:
+        logger.debug_traceback()
+        return None
+
+class SyncJournal:
+    """
+    Files committed to a storage since its listing was last saved.
+
+    Each upload appends one `(key, size, mtime ms)` record, so a sync
+    interrupted by a restart only loses the file it was writing, and the
+    next sync can trust the saved listing merged with the journal instead
+    of downloading the same files again. `clear` once the listing is saved.
+    """
+    def __init__(
+        self,
+        path: Path
+    ):
+        self.path = path
+        self._file = None
+
+    def append(
+        self,
+        hash: str,
+        size: int,
+        mtime: int
+    ):
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "ab")
+        self._file.write(JOURNAL_RECORD.pack(get_key(hash), size, mtime))
+        self._file.flush()
+
+    def load(self) -> FileTable:
+        if not self.path.exists():
+            return FileTable()
+        try:
+            data = self.path.read_bytes()
+        except:
+            logger.debug_traceback()
+            return FileTable()
+        hashes, sizes, mtimes = [], [], []
+        # a record cut short by a crash is dropped
+        for key, size, mtime in JOURNAL_RECORD.iter_unpack(data[:len(data) - len(data) % JOURNAL_RECORD.size]):
+            hashes.append(key[1:1 + key[0]].hex())
+            sizes.append(size)
+            mtimes.append(mtime)
+        return FileTable.from_columns(hashes, sizes, mtimes)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def clear(self):
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+def write_atomic(
+    path: Path,
+    data: bytes
+):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
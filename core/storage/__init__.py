@@ -1,11 +1,13 @@
 from collections import deque
 from dataclasses import dataclass
-from typing import Type
+from pathlib import Path
+import time
+from typing import Any, Optional, Type
 
 import anyio.abc
 
 
-from ..abc import BMCLAPIFile
+from ..manifest import FileTable, load_index, save_index
 from .webdav import WebDavStorage
 from .alist import AlistStorage
 from .s3 import S3Storage
@@ -13,10 +15,18 @@ from .local import LocalStorage
 from .minio import MinioStorage
 
 from .abc import FileInfo, Storage
+from ..config import cfg
 from ..logger import logger
 from .. import utils
 from tianxiu2b2t.anyio import concurrency
 
+EWMA_ALPHA = 0.2
+# latency at which a storage's weight is halved
+LATENCY_SCALE = 0.1
+MIN_WEIGHT = 0.01
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30
+
 storages: dict[str, Type[Storage]] = {
     "local": LocalStorage,
     "alist": AlistStorage,
@@ -45,14 +55,180 @@ class StorageTypeCount:
             res.append("s3")
         return "+".join(res)
 
+class FileIndex:
+    """
+    Which storages hold which file: hash -> bitset of storage positions.
+
+    Until the first sync has filled it, the index is not ready and every
+    lookup answers None, meaning "ask any storage".
+    """
+    def __init__(
+        self
+    ):
+        self._files: dict[str, int] = {}
+        self._positions: dict[Storage, int] = {}
+        self.ready = False
+
+    def add_storage(
+        self,
+        storage: Storage
+    ):
+        self._positions[storage] = len(self._positions)
+
+    def get_mask(
+        self,
+        storage: Storage
+    ) -> int:
+        return 1 << self._positions[storage]
+
+    def get(
+        self,
+        hash: str
+    ) -> Optional[int]:
+        if not self.ready:
+            return None
+        return self._files.get(hash, 0)
+
+    def add(
+        self,
+        hash: str,
+        storage: Storage
+    ):
+        self._files[hash] = self._files.get(hash, 0) | self.get_mask(storage)
+
+    def discard(
+        self,
+        hash: str,
+        storage: Storage
+    ):
+        if hash in self._files:
+            self._files[hash] &= ~self.get_mask(storage)
+
+    def update(
+        self,
+        files: FileTable,
+        check_storages: list['CheckStorage'],
+        full: bool = False
+    ):
+        """`full` when `files` is the whole manifest, anything else is dropped"""
+        checked = 0
+        for check_storage in check_storages:
+            checked |= self.get_mask(check_storage.storage)
+        if full:
+            get = self._files.get
+            self._files = {hash: get(hash, 0) | checked for hash in files.iter_hashes()}
+        else:
+            for hash in files.iter_hashes():
+                self._files[hash] = self._files.get(hash, 0) | checked
+        for check_storage in check_storages:
+            mask = ~self.get_mask(check_storage.storage)
+            for hash in check_storage.missing_files.iter_hashes():
+                self._files[hash] &= mask
+        self.ready = True
+
+    def save(
+        self,
+        path: Path
+    ):
+        """write a snapshot for the worker processes, safe to call from a thread"""
+        save_index(path, self._files.copy(), len(self._positions))
+
+    def load(
+        self,
+        path: Path
+    ) -> bool:
+        """replace the index by a snapshot of the main process"""
+        files = load_index(path, len(self._positions))
+        if files is None:
+            return False
+        self._files = files
+        self.ready = True
+        return True
+
+    def __len__(self):
+        return len(self._files)
+
+class StorageStatistics:
+    """
+    Health of one storage as seen by the balancer: EWMA latency and error
+    rate, plus a circuit breaker that opens after consecutive failures and
+    lets a single trial request through once the cooldown has passed.
+
+    While that trial is out the breaker stays open for everyone else; if it
+    never reports (the storage was only a fallback), the next cooldown
+    admits another one.
+    """
+    def __init__(
+        self,
+        storage: Storage
+    ):
+        self.storage = storage
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+        self.current_weight = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def weight(self) -> float:
+        # weight 0 (the default) means "no preference", negative means backup
+        base = max(self.storage.weight, 1)
+        return max(base * (1 - self.error_rate) / (1 + self.latency / LATENCY_SCALE), MIN_WEIGHT)
+
+    @property
+    def available(self) -> bool:
+        return self.failures < BREAKER_FAILURES or time.monotonic() >= self.open_until
+
+    def admit(self) -> bool:
+        """`available`, taking the single trial slot when the breaker is half open"""
+        if self.failures < BREAKER_FAILURES:
+            return True
+        now = time.monotonic()
+        if now < self.open_until:
+            return False
+        self.open_until = now + BREAKER_COOLDOWN
+        return True
+
+    def report(
+        self,
+        ok: bool,
+        latency: float
+    ):
+        self.requests += 1
+        self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.failures = 0
+            return
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES:
+            if self.open_until <= time.monotonic():
+                logger.twarning("storage.breaker.open", name=self.storage.name, failures=self.failures, time=BREAKER_COOLDOWN)
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    def get_info(self) -> dict[str, Any]:
+        return {
+            "online": self.storage.online,
+            "weight": self.weight,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "requests": self.requests,
+            "errors": self.errors,
+            "breaker_open": not self.available,
+        }
+
 class StorageManager:
     def __init__(
         self
     ):
         self._storages: deque[Storage] = deque()
-        self._weight_storages: deque[Storage] = deque()
+        self._statistics: dict[Storage, StorageStatistics] = {}
         self._online_storages: deque[Storage] = deque()
         self._status = False
+        self.index = FileIndex()
     
     @property
     def get_storage_type(self):
@@ -84,9 +260,8 @@ class StorageManager:
             return
         storage = storages[type](name, path, weight, **kwargs)
         self._storages.append(storage)
-        
-        if storage.weight >= 0:
-            self._weight_storages.append(storage)
+        self._statistics[storage] = StorageStatistics(storage)
+        self.index.add_storage(storage)
     
     @property
     def count(self):
@@ -98,8 +273,12 @@ class StorageManager:
     
     async def setup(
         self,
-        task_group: anyio.abc.TaskGroup
+        task_group: anyio.abc.TaskGroup,
+        measures: bool = True
     ):
+        """`measures` is off in the worker processes, the main process provisions them"""
+        for storage in self._storages:
+            storage.measures = measures
         await concurrency.gather(*(
             storage.setup(task_group)
             for storage in self._storages
@@ -119,68 +298,157 @@ class StorageManager:
             
             self._status = len(self._online_storages) > 0
 
-    def get_weight_storage(self):
-        c = None
-        back_storages: list[Storage] = []
-        for storage in self._weight_storages:
+    def get_storages(self, mask: Optional[int] = None) -> list[Storage]:
+        """
+        Candidate storages for a request, best first.
+
+        The first one is chosen by smooth weighted round-robin over weights
+        scaled by health, the rest follow by weight as retry fallbacks.
+        Storages with an open breaker, offline or without the file (per
+        `mask`) are skipped, backups (negative weight) are only used when
+        nothing else is left.
+        """
+        candidates: list[StorageStatistics] = []
+        backups: list[StorageStatistics] = []
+        for storage in self._storages:
             if not storage.online:
                 continue
-            if storage.weight < 0:
-                back_storages.append(storage)
+            if mask is not None and not mask & self.index.get_mask(storage):
+                continue
+            statistics = self._statistics[storage]
+            if not statistics.admit():
                 continue
-            if storage.current_weight < storage.weight:
-                c = storage
-                storage.current_weight += 1
-                break
-            else:
-                c = storage
-        if c is None and len(back_storages) > 0:
-            c = back_storages.pop()
-        return c
+            (candidates if storage.weight >= 0 else backups).append(statistics)
+        if not candidates:
+            candidates = backups
+        if not candidates:
+            return []
+        weights = [c.weight for c in candidates]
+        best = candidates[0]
+        for candidate, weight in zip(candidates, weights):
+            candidate.current_weight += weight
+            if candidate.current_weight > best.current_weight:
+                best = candidate
+        best.current_weight -= sum(weights)
+        return [best.storage] + [
+            c.storage for c in sorted(candidates, key=lambda c: c.weight, reverse=True) if c is not best
+        ]
+
+    def get_sources(self, mask: int) -> list[Storage]:
+        """healthy storages holding a file per `mask`, cheapest to read from first"""
+        sources = [
+            storage for storage in self._storages
+            if storage.online and mask & self.index.get_mask(storage) and self._statistics[storage].admit()
+        ]
+        return sorted(sources, key=lambda storage: (storage.read_cost, -self._statistics[storage].weight))
+
+    def get_weight_storage(self, mask: Optional[int] = None):
+        storages = self.get_storages(mask)
+        return storages[0] if storages else None
+
+    def report(
+        self,
+        storage: Storage,
+        ok: bool,
+        latency: float
+    ):
+        self._statistics[storage].report(ok, latency)
+
+    def get_statistics(self) -> dict[str, dict[str, Any]]:
+        return {
+            storage.name: statistics.get_info()
+            for storage, statistics in self._statistics.items()
+        }
             
 
 class CheckStorage:
+    """
+    Finds the files of the manifest a storage lacks, according to its
+    `check_mode`:
+
+    - exists: the file is listed
+    - size: ... with the right size (default)
+    - hash: ... and its content hashes to its name
+
+    Hashed files are remembered in `verified` as (digest, size, mtime)
+    rows of the listing, so later syncs only hash files that changed.
+    Files listed without an mtime are hashed on every sync.
+    """
     def __init__(
         self,
         storage: Storage,
+        verified: Optional[FileTable] = None
     ):
         self.storage = storage
-        self.files: dict[str, FileInfo] = {}
-        self.missing_files: set[BMCLAPIFile] = set()
+        self.listing = FileTable()
+        self.missing_files = FileTable()
+        self.verified = verified if verified is not None else FileTable()
 
-    async def get_missing_files(self, bmclapi_files: set[BMCLAPIFile], muitlpbar: utils.MultiTQDM):
-
-        for file in await self.storage.list_download_files(muitlpbar):
-            self.files[file.name] = file
+    async def get_missing_files(
+        self,
+        bmclapi_files: FileTable,
+        muitlpbar: utils.MultiTQDM,
+        listing: Optional[FileTable] = None
+    ) -> FileTable:
+        """`listing` is used instead of listing the storage"""
+        if listing is None:
+            listing = await self.list_files(muitlpbar)
+        self.listing = listing
         muitlpbar.update(1)
 
-        # start check
-        # with concurreny
-        async with anyio.create_task_group() as task_group:
-            # spilt bmclapi_files into 10 parts
-            for files in utils.split_workload(list(bmclapi_files), 10):
-                task_group.start_soon(self._check, files)
-
+        mode = self.storage.check_mode
+        self.missing_files = bmclapi_files.difference(listing, sizes=mode != "exists")
+        if mode == "hash":
+            await self._check_hashes(bmclapi_files, muitlpbar)
         return self.missing_files
 
-    async def _check(
+    async def list_files(
         self,
-        files: list[BMCLAPIFile]
-    ):
-        for file in files:
-            if await self._check_file(file):
-                continue
-            self.missing_files.add(file)
+        muitlpbar: utils.MultiTQDM
+    ) -> FileTable:
+        infos = await self.storage.list_download_files(muitlpbar)
+        return FileTable.from_columns(
+            [info.name for info in infos],
+            [info.size for info in infos],
+            [int(info.mtime * 1000) for info in infos]
+        )
 
+    async def _check_hashes(
+        self,
+        bmclapi_files: FileTable,
+        muitlpbar: utils.MultiTQDM
+    ):
+        listing = self.listing
+        # a backend reporting no mtime (0) cannot show a changed file, so those are always hashed
+        unknown = listing.take(i for i, mtime in enumerate(listing.mtimes) if mtime == 0)
+        unverified = listing.difference(self.verified, mtimes=True).merge(unknown)
+        # listed files of the manifest with the right size that were not verified yet
+        present = bmclapi_files.difference(self.missing_files)
+        files = unverified.difference(unverified.difference(present))
+        results: list[Optional[str]] = [None] * len(files)
 
-    async def _check_file(self, file: BMCLAPIFile):
-        # default use check exists + size
-        return await self._check_file_size(file)
-        
-    async def _check_file_size(self, file: BMCLAPIFile):
-        return await self._check_file_exists(file) and self.files[file.hash].size == file.size
-        
-    async def _check_file_exists(self, file: BMCLAPIFile):
-        return file.hash in self.files
-            
+        with muitlpbar.sub(
+            len(files),
+            description=f"Checking files in {self.storage.name}({self.storage.type})"
+        ) as pbar:
+            async def works(indices: list[int]):
+                for i in indices:
+                    hash = files.get_hash(i)
+                    try:
+                        results[i] = await self.storage.hash_file(hash)
+                    except:
+                        logger.debug_traceback()
+                    pbar.update(1)
+            async with anyio.create_task_group() as task_group:
+                for work in utils.split_workload(list(range(len(files))), cfg.hash_workers):
+                    task_group.start_soon(works, work)
 
+        # files that could not be read stay unverified and are tried next time
+        passed = [i for i, result in enumerate(results) if result == files.get_hash(i)]
+        corrupted = [files.get_hash(i) for i, result in enumerate(results) if result is not None and result != files.get_hash(i)]
+        self.verified = listing.difference(unverified, mtimes=True).merge(files.take(passed))
+        if corrupted:
+            logger.twarning("storage.check.corrupted", name=self.storage.name, count=len(corrupted))
+            self.missing_files = self.missing_files.merge(
+                bmclapi_files.take(sorted(bmclapi_files.find(hash) for hash in corrupted))
+            )
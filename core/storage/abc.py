@@ -1,32 +1,115 @@
 import abc
 
+import aiohttp
+import anyio
 import anyio.abc
-import io
+import anyio.to_thread
+import datetime
+import email.utils
+import os
+import threading
+from typing import IO, Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Generic, Hashable, Optional, TypeVar
 
 from core import utils
-from core.abc import BMCLAPIFile, ResponseFile, ResponseFileNotFound, ResponseFileMemory, ResponseFileLocal, ResponseFileRemote
+from core.abc import BMCLAPIFile, ResponseFile, ResponseFileNotFound, ResponseFileMemory, ResponseFileLocal, ResponseFileRemote, ResponseFileStream
 from ..logger import logger
+from .cache import cache
 from tianxiu2b2t import units
 from tianxiu2b2t.anyio.concurrency import gather
 
 MEASURE_SIZES = (10, 20, 30, 40, 50, 100, 200)
+CHECK_MODES = ("exists", "size", "hash")
+STREAM_CHUNK_SIZE = 1024 * 256
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+ZERO_CHUNK = bytes(UPLOAD_CHUNK_SIZE)
+T = TypeVar("T")
+
+class SingleFlightCall(Generic[T]):
+    def __init__(
+        self
+    ):
+        self.event = anyio.Event()
+        self.result: Optional[T] = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+
+class SingleFlight(Generic[T]):
+    """
+    Coalesce concurrent calls with the same key into one in-flight call.
+
+    Followers wait for the leader and share its result or exception. If the
+    leader is cancelled, the followers race again for a new call.
+    """
+    def __init__(
+        self
+    ):
+        self._calls: dict[Hashable, SingleFlightCall[T]] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(
+        self,
+        key: Hashable,
+        func: Callable[..., Awaitable[T]],
+        *args: Any
+    ) -> T:
+        # counted once, even if a cancelled leader makes this caller race again
+        if key in self._calls:
+            self.coalesced += 1
+        while (call := self._calls.get(key)) is not None:
+            await call.event.wait()
+            if call.error is not None:
+                raise call.error
+            if call.done:
+                return call.result # type: ignore
+        call = SingleFlightCall()
+        self._calls[key] = call
+        self.calls += 1
+        try:
+            call.result = await func(*args)
+            call.done = True
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            del self._calls[key]
+            call.event.set()
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    def get_statistics(self) -> dict[str, int]:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": self.in_flight,
+        }
 
 class FileInfo:
     def __init__(
         self,
         name: str,
         size: int,
-        path: str
+        path: str,
+        mtime: float = 0
     ):
         self.name = name
         self.size = size
-        self.path = CPath(path)
+        self._path = path
+        # seconds, 0 when the backend does not report it
+        self.mtime = mtime
+
+    @property
+    def path(self) -> 'CPath':
+        return CPath(self._path)
 
     def __str__(self) -> str:
         return f"{self.name} ({self.size} bytes)"
     
     def __repr__(self) -> str:
-        return f"FileInfo(name={self.name}, size={self.size}, path={self.path})"
+        return f"FileInfo(name={self.name}, size={self.size}, path={self.path}, mtime={self.mtime})"
     
     def __hash__(self) -> int:
         return hash(self.name)
@@ -40,6 +123,8 @@ class FileInfo:
 
 class Storage(metaclass=abc.ABCMeta):
     type: str = "_inerface"
+    # relative cost of reading files back, the cheapest source is replicated from
+    read_cost: int = 1
     def __init__(
         self,
         name: str,
@@ -53,8 +138,10 @@ class Storage(metaclass=abc.ABCMeta):
         self.readonly = False
         self.online = False
         self.weight = weight
-        self.current_weight = 0
         self._kwargs = kwargs
+        self._teeing: set[str] = set()
+        # measures are provisioned by the main process only, see `StorageManager.setup`
+        self.measures = True
 
     @property
     def cache_size(self):
@@ -64,10 +151,33 @@ class Storage(metaclass=abc.ABCMeta):
     def cache_ttl(self):
         return units.parse_time_units(self._kwargs.get("cache_ttl", "10m"))
     
+    @property
+    def stream_threshold(self):
+        """objects larger than this are streamed to the client instead of buffered"""
+        return units.parse_number_units(str(self._kwargs.get("stream_threshold", "4M")))
+    
     @property
     def download_dir(self):
         return bool(self._kwargs.get("add_download_dir", True))
 
+    @property
+    def check_mode(self) -> str:
+        """
+        how sync checks the files: exists, size or hash
+
+        hash results are cached by mtime, so a backend that reports
+        no mtime has its files re-hashed on every sync
+        """
+        mode = str(self._kwargs.get("check_mode", "size"))
+        if mode not in CHECK_MODES:
+            return "size"
+        return mode
+
+    @property
+    def upload_concurrency(self) -> int:
+        """files sync uploads to this storage at the same time"""
+        return max(1, int(self._kwargs.get("upload_concurrency", 8)))
+
     @abc.abstractmethod
     async def setup(
         self,
@@ -75,7 +185,8 @@ class Storage(metaclass=abc.ABCMeta):
     ):
         self._task_group = task_group
 
-        task_group.start_soon(self.check_measures)
+        if self.measures:
+            task_group.start_soon(self.check_measures)
 
 
     async def check_measures(self):
@@ -151,25 +262,62 @@ class Storage(metaclass=abc.ABCMeta):
     async def upload(
         self,
         path: str,
-        data: io.BytesIO,
+        data: AsyncIterable[bytes],
         size: int
     ):
+        """store `size` bytes read from `data` at `path`, the stream is consumed once"""
         raise NotImplementedError
 
-    async def upload_download_file(self, path: str, data: io.BytesIO, size: int):
+    async def upload_download_file(self, hash: str, data: AsyncIterable[bytes], size: int):
+        await self.upload(self.get_download_path(hash), data, size)
+
+    def get_download_path(
+        self,
+        hash: str
+    ) -> str:
+        path = f"{hash[:2]}/{hash}"
         if self.download_dir:
             path = f"download/{path}"
-        await self.upload(f"download/{path}", data, size)
+        return path
 
     async def get_response_file(
         self,
         hash: str
     ) -> ResponseFile:
-        path = f"{hash[:2]}/{hash}"
-        if self.download_dir:
-            path = f"download/{path}"
-        
-        return await self.get_file(path)
+        return await self.fetch_file(self.get_download_path(hash))
+
+    async def hash_file(
+        self,
+        hash: str
+    ) -> Optional[str]:
+        """
+        Hexdigest of the stored file named `hash`, computed with the same
+        algorithm, None if it cannot be read. Local files are hashed on the
+        hash thread pool, anything else is streamed from the backend
+        through `utils.hash_stream`.
+        """
+        file = await self.get_file(self.get_download_path(hash))
+        if isinstance(file, ResponseFileLocal):
+            return await anyio.to_thread.run_sync(utils.hash_local_file, file.path, hash, limiter=utils.get_hash_limiter())
+        try:
+            return await utils.hash_stream(iter_response_file(file), utils.get_hash_obj(hash))
+        except FileNotFoundError:
+            return None
+
+    async def iter_download_file(
+        self,
+        hash: str
+    ) -> AsyncIterator[bytes]:
+        """content of the stored file named `hash`, FileNotFoundError if it cannot be read"""
+        async for chunk in iter_response_file(await self.get_file(self.get_download_path(hash))):
+            yield chunk
+
+    async def fetch_file(
+        self,
+        path: str,
+    ) -> ResponseFile:
+        """`get_file` with concurrent lookups of the same path coalesced"""
+        return await single_flight.do((self.name, path), self.get_file, path)
 
     @abc.abstractmethod
     async def get_file(
@@ -178,6 +326,33 @@ class Storage(metaclass=abc.ABCMeta):
     ) -> ResponseFile:
         raise NotImplementedError
 
+    def stream_file(
+        self,
+        cache_key: str,
+        size: int,
+        open_stream: Callable[[int, int], AsyncIterator[bytes]]
+    ) -> ResponseFileStream:
+        """
+        Wrap a ranged backend reader. A full read of an object small enough
+        for the object cache is teed into it, one tee per object at a time.
+        """
+        async def stream(offset: int, length: int):
+            buffer = None
+            if offset == 0 and length == size and size <= cache.max_object_size and cache_key not in self._teeing:
+                buffer = bytearray()
+                self._teeing.add(cache_key)
+            try:
+                async for chunk in open_stream(offset, length):
+                    if buffer is not None:
+                        buffer.extend(chunk)
+                    yield chunk
+                if buffer is not None and len(buffer) == size:
+                    cache.set(self, cache_key, ResponseFileMemory(bytes(buffer), size))
+            finally:
+                if buffer is not None:
+                    self._teeing.discard(cache_key)
+        return ResponseFileStream(size, stream)
+
     @property
     def task_group(self) -> anyio.abc.TaskGroup:
         if self._task_group is None:
@@ -199,14 +374,18 @@ class Storage(metaclass=abc.ABCMeta):
         
         await self.upload(
             path,
-            io.BytesIO(b"\x00" * size),
+            iter_zeros(size),
             size
         )
         logger.tsuccess("storage.write_measure", size=int(size / (1024 * 1024)), name=self.name, type=self.type)
 
 
+    def get_py_check_name(self) -> str:
+        # one per process, workers check the same storage concurrently
+        return f".py_check.{os.getpid()}"
+
     def get_py_check_path(self) -> 'CPath':
-        return self.path / ".py_check"
+        return self.path / self.get_py_check_name()
 
     def emit_status(self):
         logger.debug(f"Storage {self.name} online status: {self.online}")
@@ -282,4 +461,183 @@ class CPath:
         return self._path
     
 
-RANGE = range(0x00, 0xFF + 1)
\ No newline at end of file
+class StreamReader:
+    """`read` over an async byte stream, for clients that pull their upload body"""
+    def __init__(
+        self,
+        stream: AsyncIterable[bytes]
+    ):
+        self._stream = stream.__aiter__()
+        self._buffer = bytearray()
+        self._eof = False
+
+    async def read(
+        self,
+        size: int = -1
+    ) -> bytes:
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            try:
+                self._buffer += await self._stream.__anext__()
+            except StopAsyncIteration:
+                self._eof = True
+        if size < 0 or size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+async def iter_bytes(
+    data: bytes
+) -> AsyncIterator[bytes]:
+    yield data
+
+async def iter_zeros(
+    size: int
+) -> AsyncIterator[bytes]:
+    while size > 0:
+        chunk = ZERO_CHUNK if size >= len(ZERO_CHUNK) else ZERO_CHUNK[:size]
+        yield chunk
+        size -= len(chunk)
+
+async def iter_fileobj(
+    file: IO[bytes],
+    threaded: bool = True
+) -> AsyncIterator[bytes]:
+    """
+    `file` from its start, read in a worker thread unless it is in memory.
+
+    Every chunk is read at its own offset, so several uploads can read
+    the same file at once.
+    """
+    offset = 0
+    if not threaded:
+        while True:
+            file.seek(offset)
+            if not (data := file.read(UPLOAD_CHUNK_SIZE)):
+                return
+            offset += len(data)
+            yield data
+    await anyio.to_thread.run_sync(file.flush)
+    while (data := await anyio.to_thread.run_sync(read_at, file, offset, UPLOAD_CHUNK_SIZE)):
+        offset += len(data)
+        yield data
+
+async def iter_response_file(
+    file: ResponseFile
+) -> AsyncIterator[bytes]:
+    """content of a `get_file` response, FileNotFoundError if there is none"""
+    if isinstance(file, ResponseFileLocal):
+        with await anyio.to_thread.run_sync(open, file.path, "rb") as f:
+            async for chunk in iter_fileobj(f):
+                yield chunk
+    elif isinstance(file, ResponseFileMemory):
+        yield file.data
+    elif isinstance(file, ResponseFileStream):
+        async for chunk in file.stream(0, file.size):
+            yield chunk
+    elif isinstance(file, ResponseFileRemote):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(file.url) as resp:
+                if resp.status != 200:
+                    raise FileNotFoundError(file.url)
+                async for chunk in resp.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+                    yield chunk
+    else:
+        raise FileNotFoundError(repr(file))
+
+async def iter_verified(
+    chunks: AsyncIterable[bytes],
+    hash: str,
+    size: int,
+    check_hash: bool = False
+) -> AsyncIterator[bytes]:
+    """
+    `chunks` of the file named `hash`, raising ValueError unless they add
+    up to `size` (and hash to `hash`). The last chunk is held back until
+    then, so an upload reading this never completes with a bad file.
+    """
+    obj = utils.get_hash_obj(hash) if check_hash else None
+    total = 0
+    last: Optional[bytes] = None
+    async for chunk in chunks:
+        total += len(chunk)
+        if total > size:
+            raise ValueError(f"size mismatch, got more than {size} bytes of {hash}")
+        if obj is not None:
+            await anyio.to_thread.run_sync(obj.update, chunk, limiter=utils.get_hash_limiter())
+        if last is not None:
+            yield last
+        last = chunk
+    if total != size:
+        raise ValueError(f"size mismatch, got {total} bytes of {hash} expected {size}")
+    if obj is not None and obj.hexdigest() != hash:
+        raise ValueError(f"hash mismatch, got {obj.hexdigest()} expected {hash}")
+    if last is not None:
+        yield last
+
+_read_lock = threading.Lock()
+
+def read_at(
+    file: IO[bytes],
+    offset: int,
+    size: int
+) -> bytes:
+    """up to `size` bytes of `file` at `offset` without moving a position shared with other readers, blocking"""
+    if hasattr(os, "pread"):
+        return os.pread(file.fileno(), size, offset)
+    with _read_lock:
+        file.seek(offset)
+        return file.read(size)
+
+def parse_mtime(
+    value: Any
+) -> float:
+    """modification time reported by a backend (datetime, ISO 8601 or RFC 1123) in seconds, 0 if unknown"""
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str) or not value:
+        return 0
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        ...
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+async def iter_response(
+    resp: aiohttp.ClientResponse,
+    offset: int,
+    length: int
+) -> AsyncIterator[bytes]:
+    """
+    Yield `length` bytes of a ranged response, skipping up to `offset`
+    when the server ignored the `Range` header and answered 200.
+    """
+    skip = offset if resp.status == 200 else 0
+    async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+        if skip:
+            if len(chunk) <= skip:
+                skip -= len(chunk)
+                continue
+            chunk, skip = chunk[skip:], 0
+        if len(chunk) >= length:
+            yield chunk[:length]
+            return
+        length -= len(chunk)
+        yield chunk
+
+def get_range_header(
+    offset: int,
+    length: int
+) -> str:
+    return f"bytes={offset}-{offset + length - 1}"
+
+RANGE = range(0x00, 0xFF + 1)
+
+single_flight: SingleFlight[ResponseFile] = SingleFlight()
\ No newline at end of file
@@ -1,11 +1,11 @@
-import io
 import time
-from typing import Any
+from typing import Any, AsyncIterable
 import urllib.parse as urlparse
 import aiohttp
 import anyio.abc
 
 from . import abc
+from .cache import cache
 from ..config import USER_AGENT
 from .. import utils
 from ..logger import logger
@@ -27,9 +27,14 @@ class AlistResponse:
             return
         raise Exception(f"Status: {self.code}, message: {self.message}")
         
+def is_not_found(resp: AlistResponse):
+    # alist reports a missing object as a server error carrying "object not found"
+    return resp.code == 404 or (resp.code == 500 and "not found" in str(resp.message).lower())
+
 
 class AlistStorage(abc.Storage):
     type = "alist"
+    read_cost = 2
     def __init__(
         self,
         name: str,
@@ -44,10 +49,6 @@ class AlistStorage(abc.Storage):
         self._endpoint = endpoint
         self._username = username
         self._password = password
-        self._redirect_urls: utils.UnboundTTLCache[str, abc.ResponseFile] = utils.UnboundTTLCache(
-            maxsize=self.cache_size, 
-            ttl=self.cache_ttl
-        )
         self._token = None
     
     async def _get_token(self):
@@ -104,7 +105,7 @@ class AlistStorage(abc.Storage):
                         data={
                             "dir": str(self._path),
                             "names": [
-                                ".py_check"
+                                self.get_py_check_name()
                             ]
                         }
                     ) as resp:
@@ -171,10 +172,11 @@ class AlistStorage(abc.Storage):
                         name=item["name"],
                         size=item["size"],
                         path=str(root / item["name"]),
+                        mtime=abc.parse_mtime(item.get("modified")),
                     ))
         return res
     
-    async def upload(self, path: str, data: io.BytesIO, size: int):
+    async def upload(self, path: str, data: AsyncIterable[bytes], size: int):
         async with aiohttp.ClientSession(
             base_url=self._endpoint,
             headers={
@@ -186,8 +188,9 @@ class AlistStorage(abc.Storage):
                 f"/api/fs/put",
                 headers={
                     "File-Path": urlparse.quote(str(self._path / path)),
+                    "Content-Length": str(size),
                 },
-                data=data.getbuffer()
+                data=data
             ) as resp:
                 alist_resp = AlistResponse(await resp.json())
                 alist_resp.raise_for_status()
@@ -195,7 +198,7 @@ class AlistStorage(abc.Storage):
     
     async def get_file(self, path: str) -> abc.ResponseFile:
         path = str(self._path / path)
-        val = self._redirect_urls.get(path)
+        val = cache.get(self, path)
         if val is not None:
             return val
         async with aiohttp.ClientSession(
@@ -212,8 +215,12 @@ class AlistStorage(abc.Storage):
                 }
             ) as resp:
                 data = AlistResponse(await resp.json())
-                self._redirect_urls[path] = abc.ResponseFileRemote(
+                if is_not_found(data):
+                    return abc.ResponseFileNotFound()
+                data.raise_for_status()
+                val = abc.ResponseFileRemote(
                     url=data.data["raw_url"],
                     size=data.data["size"]
                 )
-        return self._redirect_urls[path]
\ No newline at end of file
+                cache.set(self, path, val)
+        return val
\ No newline at end of file
@@ -0,0 +1,198 @@
+from collections import OrderedDict, defaultdict
+from dataclasses import asdict, dataclass
+import time
+from typing import TYPE_CHECKING, Any, Optional
+
+from ..abc import ResponseFile, ResponseFileMemory, ResponseFileRemote
+from ..config import cfg
+
+if TYPE_CHECKING:
+    from .abc import Storage
+
+# rough per-entry bookkeeping cost: key tuple, entry object, dict slots
+ENTRY_OVERHEAD = 256
+MAX_FREQUENCY = 3
+
+@dataclass
+class CacheStatistics:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    count: int = 0
+    bytes: int = 0
+
+class CacheEntry:
+    __slots__ = ("key", "value", "size", "expires", "freq", "main")
+
+    def __init__(
+        self,
+        key: tuple[str, str],
+        value: ResponseFile,
+        size: int,
+        expires: float,
+    ):
+        self.key = key
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.freq = 0
+        self.main = False
+
+class ObjectCache:
+    """
+    Process-wide byte-budgeted cache for `ResponseFile` objects.
+
+    Eviction follows S3-FIFO: new objects land in a small FIFO (10% of the
+    budget), objects read again before leaving it are promoted to the main
+    FIFO, the rest are evicted and remembered in a ghost queue so a quick
+    re-insert goes straight to main. Entries still expire after the ttl of
+    the storage that put them, so presigned urls never outlive themselves.
+    """
+    def __init__(
+        self,
+        capacity: float,
+        timer = time.monotonic
+    ):
+        self.capacity = capacity
+        self.small_capacity = capacity * 0.1
+        self.max_object_size = capacity / 8
+        self._timer = timer
+        self._small: OrderedDict[tuple[str, str], CacheEntry] = OrderedDict()
+        self._main: OrderedDict[tuple[str, str], CacheEntry] = OrderedDict()
+        self._ghost: OrderedDict[tuple[str, str], None] = OrderedDict()
+        self._small_bytes = 0
+        self._main_bytes = 0
+        self._statistics: defaultdict[str, CacheStatistics] = defaultdict(CacheStatistics)
+
+    @property
+    def size(self):
+        return self._small_bytes + self._main_bytes
+
+    def get(
+        self,
+        storage: 'Storage',
+        path: str
+    ) -> Optional[ResponseFile]:
+        key = (storage.name, path)
+        statistics = self._statistics[storage.name]
+        entry = self._small.get(key) or self._main.get(key)
+        if entry is not None and entry.expires <= self._timer():
+            self._remove(entry)
+            statistics.expirations += 1
+            entry = None
+        if entry is None:
+            statistics.misses += 1
+            return None
+        entry.freq = min(entry.freq + 1, MAX_FREQUENCY)
+        statistics.hits += 1
+        return entry.value
+
+    def set(
+        self,
+        storage: 'Storage',
+        path: str,
+        value: ResponseFile,
+        ttl: Optional[float] = None
+    ):
+        key = (storage.name, path)
+        old = self._small.get(key) or self._main.get(key)
+        if old is not None:
+            self._remove(old)
+        size = get_size(value)
+        if size > self.max_object_size:
+            return
+        entry = CacheEntry(key, value, size, self._timer() + (ttl if ttl is not None else storage.cache_ttl))
+        if key in self._ghost:
+            del self._ghost[key]
+            self._insert_main(entry)
+        else:
+            self._small[key] = entry
+            self._small_bytes += size
+        statistics = self._statistics[storage.name]
+        statistics.count += 1
+        statistics.bytes += size
+        while self.size > self.capacity:
+            self._evict()
+
+    def delete(
+        self,
+        storage: 'Storage',
+        path: str
+    ):
+        key = (storage.name, path)
+        entry = self._small.get(key) or self._main.get(key)
+        if entry is not None:
+            self._remove(entry)
+
+    def get_statistics(self) -> dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "size": self.size,
+            "storages": {
+                name: asdict(statistics)
+                for name, statistics in self._statistics.items()
+            }
+        }
+
+    def _insert_main(self, entry: CacheEntry):
+        entry.main = True
+        self._main[entry.key] = entry
+        self._main_bytes += entry.size
+
+    def _remove(self, entry: CacheEntry):
+        if entry.main:
+            del self._main[entry.key]
+            self._main_bytes -= entry.size
+        else:
+            del self._small[entry.key]
+            self._small_bytes -= entry.size
+        statistics = self._statistics[entry.key[0]]
+        statistics.count -= 1
+        statistics.bytes -= entry.size
+
+    def _evict(self):
+        if self._small and (self._small_bytes >= self.small_capacity or not self._main):
+            self._evict_small()
+        else:
+            self._evict_main()
+
+    def _evict_small(self):
+        _, entry = self._small.popitem(last=False)
+        self._small_bytes -= entry.size
+        if entry.freq > 0:
+            entry.freq = 0
+            self._insert_main(entry)
+            return
+        self._ghost[entry.key] = None
+        while len(self._ghost) > max(len(self._main), 1024):
+            self._ghost.popitem(last=False)
+        self._evicted(entry)
+
+    def _evict_main(self):
+        while self._main:
+            _, entry = self._main.popitem(last=False)
+            if entry.freq > 0:
+                entry.freq -= 1
+                self._main[entry.key] = entry
+                continue
+            self._main_bytes -= entry.size
+            self._evicted(entry)
+            return
+
+    def _evicted(self, entry: CacheEntry):
+        statistics = self._statistics[entry.key[0]]
+        statistics.evictions += 1
+        statistics.count -= 1
+        statistics.bytes -= entry.size
+
+def get_size(
+    value: ResponseFile
+) -> int:
+    if isinstance(value, ResponseFileMemory):
+        return len(value.data) + ENTRY_OVERHEAD
+    if isinstance(value, ResponseFileRemote):
+        return len(value.url) + ENTRY_OVERHEAD
+    return ENTRY_OVERHEAD
+
+cache = ObjectCache(cfg.object_cache_size)
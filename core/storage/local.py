@@ -1,6 +1,8 @@
+import os
 from pathlib import Path
-import io
 import time
+from typing import AsyncIterable
+import anyio
 import anyio.abc
 
 from core.abc import ResponseFile, ResponseFileLocal, ResponseFileNotFound
@@ -11,6 +13,7 @@ from .abc import FileInfo, Storage
 
 class LocalStorage(Storage):
     type = "local"
+    read_cost = 0
     def __init__(
         self,
         name: str,
@@ -43,29 +46,39 @@ class LocalStorage(Storage):
         for file in root.iterdir():
             if not file.is_file():
                 continue
+            stat = file.stat()
             res.append(FileInfo(
                 name=file.name,
-                size=file.stat().st_size,
-                path=str(file.relative_to(root))
+                size=stat.st_size,
+                path=str(file.relative_to(root)),
+                mtime=stat.st_mtime
             ))
         return res
     
     async def upload(
         self,
         path: str,
-        data: io.BytesIO,
+        data: AsyncIterable[bytes],
         size: int
     ):
         root = Path(str(self.path)) / path
         root.parent.mkdir(parents=True, exist_ok=True)
-        with open(root, "wb") as f:
-            f.write(data.getbuffer())
+        # written aside and renamed, so a partial upload is never served
+        tmp = root.with_name(f"{root.name}.{os.getpid()}.tmp")
+        try:
+            async with await anyio.open_file(tmp, "wb") as f:
+                async for chunk in data:
+                    await f.write(chunk)
+            os.replace(tmp, root)
+        except:
+            tmp.unlink(missing_ok=True)
+            raise
         return True
 
     async def _check(
         self,
     ):
-        file = Path(str(self.path)) / ".py_check"
+        file = Path(str(self.get_py_check_path()))
         while 1:
             try:
                 file.write_text(str(time.perf_counter_ns()))
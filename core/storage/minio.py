@@ -1,20 +1,23 @@
 from datetime import timedelta
 import datetime
+from functools import partial
 import io
 import time
-from typing import Optional
+from typing import AsyncIterable, Optional
 import urllib.parse as urlparse
 import aiohttp
 import anyio.abc
 
-from ..abc import ResponseFile, ResponseFileMemory, ResponseFileRemote
-from ..utils import UnboundTTLCache
+from ..abc import ResponseFile, ResponseFileMemory, ResponseFileNotFound, ResponseFileRemote
 from ..logger import logger
+from .. import utils
 
-from .abc import CPath, FileInfo, Storage
+from .abc import CPath, FileInfo, Storage, StreamReader, iter_response, parse_mtime
+from .cache import cache
 from miniopy_async import Minio
 from miniopy_async.api import BaseURL, presign_v4
 from miniopy_async.datatypes import Object
+from miniopy_async.error import S3Error
 
 
 class MinioStorage(Storage):
@@ -41,10 +44,6 @@ class MinioStorage(Storage):
         self.public_endpoint = kwargs.get("public_endpoint")
     
         url = urlparse.urlparse(self.endpoint)
-        self._cache: UnboundTTLCache[str, ResponseFile] = UnboundTTLCache(
-            maxsize=self.cache_size, 
-            ttl=self.cache_ttl
-        )
 
         self.minio = Minio(
             endpoint=url.netloc,
@@ -86,13 +85,14 @@ class MinioStorage(Storage):
                 name=CPath(obj.object_name).name,
                 size=int(obj.size or 0),
                 path=str(obj.object_name),
+                mtime=parse_mtime(obj.last_modified),
             ))
         return res
     
     async def upload(
         self,
         path: str,
-        data: io.BytesIO,
+        data: AsyncIterable[bytes],
         size: int
     ):
         root = self.path / path
@@ -100,7 +100,7 @@ class MinioStorage(Storage):
         await self.minio.put_object(
             self.bucket,
             str(root)[1:],
-            data.getbuffer(),
+            StreamReader(data),
             size
         )
         return True
@@ -129,7 +129,7 @@ class MinioStorage(Storage):
     async def get_file(self, path: str) -> ResponseFile:
         cpath = str(self.path / path)
         # get file info
-        file = self._cache.get(cpath)
+        file = cache.get(self, cpath)
         if file is not None:
             return file
         try:
@@ -137,11 +137,10 @@ class MinioStorage(Storage):
                 self.bucket,
                 cpath[1:],
             )
-        except:
-            stat = Object(
-                bucket_name=self.bucket,
-                object_name=cpath[1:],
-            )
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchObject"):
+                return ResponseFileNotFound()
+            raise
         if stat.size == 0:
             file = ResponseFileMemory(
                 b"",
@@ -165,6 +164,8 @@ class MinioStorage(Storage):
                 url,
                 int(stat.size or 0),
             )
+        elif int(stat.size or 0) > self.stream_threshold:
+            file = self.stream_file(cpath, int(stat.size or 0), partial(self._stream, cpath))
         else:
             async with aiohttp.ClientSession() as session:
                 async with (await self.minio.get_object(
@@ -176,9 +177,32 @@ class MinioStorage(Storage):
                         await resp.read(),
                         int(stat.size or 0),
                     )
-        self._cache[cpath] = file
+        cache.set(self, cpath, file)
         return file
 
+    async def hash_file(self, hash: str) -> Optional[str]:
+        """trusts a plain md5 ETag when it matches, otherwise streams the object past the object cache"""
+        cpath = str(self.path / self.get_download_path(hash))
+        stat = await self.minio.stat_object(
+            self.bucket,
+            cpath[1:],
+        )
+        if len(hash) == 32 and (stat.etag or "").strip('"') == hash:
+            return hash
+        return await utils.hash_stream(self._stream(cpath, 0, int(stat.size or 0)), utils.get_hash_obj(hash))
+
+    async def _stream(self, cpath: str, offset: int, length: int):
+        async with aiohttp.ClientSession() as session:
+            async with (await self.minio.get_object(
+                self.bucket,
+                cpath[1:],
+                session,
+                offset=offset,
+                length=length
+            )) as resp:
+                async for chunk in iter_response(resp, offset, length):
+                    yield chunk
+
     async def check_measure(self, size: int) -> bool:
         cpath = str(self.path / "measure" / size)
         stat = await self.minio.stat_object(
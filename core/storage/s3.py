@@ -1,15 +1,18 @@
+from functools import partial
 from io import BytesIO
-import io
 import time
+from typing import AsyncIterable
 import aioboto3.session
 import anyio.abc
 import anyio.to_thread
 import aioboto3
+import botocore.exceptions
 import urllib.parse as urlparse
 
 from ..logger import logger
 from ..utils import UnboundTTLCache
 from . import abc
+from .cache import cache
 
 class S3ResponseMetadata:
     def __init__(
@@ -61,10 +64,6 @@ class S3Storage(abc.Storage):
         self.custom_s3_host = kwargs.get("custom_s3_host", "")
         self.public_endpoint = kwargs.get("public_endpoint", "")
         self.session = aioboto3.Session()
-        self._cache: UnboundTTLCache[str, abc.ResponseFile] = UnboundTTLCache(
-            maxsize=self.cache_size, 
-            ttl=self.cache_ttl
-        )
         self._cache_files: UnboundTTLCache[str, abc.FileInfo] = UnboundTTLCache(
             maxsize=self.cache_size, 
             ttl=self.cache_ttl
@@ -122,6 +121,7 @@ class S3Storage(abc.Storage):
                         name=file_name,
                         size=content["Size"],
                         path=f'/{content["Key"]}',
+                        mtime=abc.parse_mtime(content.get("LastModified")),
                     ))
 
                 #res.extend(response.get("Contents", []))  # 添加文件
@@ -136,7 +136,7 @@ class S3Storage(abc.Storage):
     async def upload(
         self,
         path: str,
-        data: io.BytesIO,
+        data: AsyncIterable[bytes],
         size: int
     ):
         async with self.session.resource(
@@ -148,7 +148,7 @@ class S3Storage(abc.Storage):
         ) as resource:
             bucket = await resource.Bucket(self.bucket)
             obj = await bucket.Object(str(self.path / path))
-            await obj.upload_fileobj(data)
+            await obj.upload_fileobj(abc.StreamReader(data))
         return True
 
 
@@ -180,21 +180,28 @@ class S3Storage(abc.Storage):
         cname = str((self.path / path).name)
         cpath = str(self.path / path)
         fileinfo = self._cache_files.get(path)
-        file = self._cache.get(path)
+        file = cache.get(self, path)
         if file is not None:
             return file
 
         if fileinfo is None:
-            async with self.session.resource(
+            async with self.session.client(
                 "s3",
                 endpoint_url=self.endpoint,
                 aws_access_key_id=self.access_key,
                 aws_secret_access_key=self.secret_key,
                 region_name=self.region
-            ) as resource:
-                bucket = await resource.Bucket(self.bucket)
-                obj = await bucket.Object(cpath)
-                info = await obj.get()
+            ) as client: # type: ignore
+                # only the metadata, the body is fetched below if it is needed at all
+                try:
+                    info = await client.head_object(
+                        Bucket=self.bucket,
+                        Key=cpath
+                    )
+                except botocore.exceptions.ClientError as e:
+                    if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                        return abc.ResponseFileNotFound()
+                    raise
                 fileinfo = abc.FileInfo(
                     name=cname,
                     size=info["ContentLength"],
@@ -238,12 +245,18 @@ class S3Storage(abc.Storage):
                         urlobj.fragment,
                     )
                 )
-                self._cache[path] = abc.ResponseFileRemote(
+                file = abc.ResponseFileRemote(
                     url,
                     fileinfo.size
                 )
-                return self._cache[path]
+                cache.set(self, path, file)
+                return file
             
+        if fileinfo.size > self.stream_threshold:
+            # the stream opens its own ranged request, nothing to fetch here
+            file = self.stream_file(path, fileinfo.size, partial(self._stream, cpath))
+            cache.set(self, path, file)
+            return file
         async with self.session.resource(
             "s3",
             endpoint_url=self.endpoint,
@@ -256,11 +269,33 @@ class S3Storage(abc.Storage):
             # read data
             content = await obj.get()
             size = content['ContentLength']
-            self._cache[path] = abc.ResponseFileMemory(
+            file = abc.ResponseFileMemory(
                 await content['Body'].read(),
                 size
             )
-        return self._cache[path]
+            cache.set(self, path, file)
+        return file
+
+    async def _stream(self, cpath: str, offset: int, length: int):
+        async with self.session.resource(
+            "s3",
+            endpoint_url=self.endpoint,
+            aws_access_key_id=self.access_key,
+            aws_secret_access_key=self.secret_key,
+            region_name=self.region
+        ) as resource:
+            bucket = await resource.Bucket(self.bucket)
+            obj = await bucket.Object(cpath)
+            content = await obj.get(
+                Range=abc.get_range_header(offset, length)
+            )
+            async with content['Body'] as body:
+                async for chunk in body.iter_chunks(abc.STREAM_CHUNK_SIZE):
+                    if len(chunk) >= length:
+                        yield chunk[:length]
+                        return
+                    length -= len(chunk)
+                    yield chunk
             
 
     async def check_measure(self, size: int) -> bool:
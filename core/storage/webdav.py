@@ -1,11 +1,15 @@
+from functools import partial
 import io
 import time
+from typing import AsyncIterable
 import aiohttp
 import aiowebdav.client
+from aiowebdav.urn import Urn
 import anyio
 from anyio.abc._tasks import TaskGroup as TaskGroup
 
 from . import abc
+from .cache import cache
 from ..logger import logger
 from ..config import USER_AGENT
 from .. import utils
@@ -15,6 +19,7 @@ import aiowebdav
 
 class WebDavStorage(abc.Storage):
     type = "webdav"
+    read_cost = 2
     def __init__(
         self,
         name: str,
@@ -29,10 +34,6 @@ class WebDavStorage(abc.Storage):
         self.endpoint = endpoint
         self.username = username
         self.password = password
-        self._cache_redirects: utils.UnboundTTLCache[str, abc.ResponseFile] = utils.UnboundTTLCache(
-            maxsize=self.cache_size, 
-            ttl=self.cache_ttl
-        )
         self._cache_files: utils.UnboundTTLCache[str, abc.FileInfo] = utils.UnboundTTLCache(
             maxsize=self.cache_size, 
             ttl=self.cache_ttl
@@ -74,6 +75,7 @@ class WebDavStorage(abc.Storage):
                     path=str(root / res['name']),
                     size=int(res['size']),
                     name=res['name'],
+                    mtime=abc.parse_mtime(res.get('modified')),
                 ))
         except:
             logger.debug_traceback()
@@ -92,21 +94,27 @@ class WebDavStorage(abc.Storage):
             )
             self._cache_files[path] = info
         if info is None:
-            return abc.ResponseFile(0)
-        file = self._cache_redirects.get(path)
+            return abc.ResponseFileNotFound()
+        file = cache.get(self, path)
         if file is not None:
             return file
+        stream = info.size > self.stream_threshold
         async with aiohttp.ClientSession(
             auth=aiohttp.BasicAuth(self.username, self.password),
             headers={
                 'User-Agent': USER_AGENT
             }
         ) as session:
-            async with session.get(
+            # a streamed file only needs to know whether it is redirected,
+            # its body comes from the ranged request of `_stream`
+            async with session.request(
+                "HEAD" if stream else "GET",
                 self.endpoint + path,
                 allow_redirects=False
             ) as resp:
-                if resp.status == 200:
+                if resp.status == 200 and stream:
+                    file = self.stream_file(path, info.size, partial(self._stream, path))
+                elif resp.status == 200:
                     file = abc.ResponseFileMemory(
                         data=await resp.read(),
                         size=info.size
@@ -116,22 +124,51 @@ class WebDavStorage(abc.Storage):
                         url=resp.headers['Location'],
                         size=info.size
                     )
+                elif resp.status == 404:
+                    self._cache_files.pop(path, None)
+                    return abc.ResponseFileNotFound()
                 else:
                     logger.error(f"WebDavStorage: Unknown status code {resp.status} for {path}")
-        self._cache_redirects[path] = file or abc.ResponseFile(0)
-        return self._cache_redirects[path]
+                    raise Exception(f"Status: {resp.status}")
+        cache.set(self, path, file)
+        return file
 
     
 
+    async def _stream(self, path: str, offset: int, length: int):
+        async with aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth(self.username, self.password),
+            headers={
+                'User-Agent': USER_AGENT
+            }
+        ) as session:
+            async with session.get(
+                self.endpoint + path,
+                headers={
+                    "Range": abc.get_range_header(offset, length)
+                }
+            ) as resp:
+                resp.raise_for_status()
+                async for chunk in abc.iter_response(resp, offset, length):
+                    yield chunk
+
     async def _mkdir(self, parent: abc.CPath):
         async with self._mkdir_lock:
             for parent in parent.parents:
                 await self.client.mkdir(str(parent))
 
-    async def upload(self, path: str, data: io.BytesIO, size: int):
+    async def upload(self, path: str, data: AsyncIterable[bytes], size: int):
         # check dir
         await self._mkdir((self._path / path).parent)
-        await self.client.upload_to(io.BytesIO(data.getbuffer()), str(self._path / path))
+        # an explicit length keeps aiohttp from falling back to chunked
+        # encoding, which servers such as nginx dav refuse with 411
+        resp = await self.client.execute_request(
+            action="upload",
+            path=Urn(str(self._path / path)).quote(),
+            data=data,
+            headers_ext=[f"Content-Length: {size}"]
+        )
+        resp.release()
         return True
     
     
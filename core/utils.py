@@ -1,13 +1,16 @@
 from collections import defaultdict, deque
+from dataclasses import dataclass, field
 import hashlib
-import io
+import heapq
 import math
 from pathlib import Path
 import time
 from typing import (
     Any, 
+    AsyncIterable,
     Awaitable, 
     Callable, 
+    Generic,
     Optional, 
     TypeVar, 
 )
@@ -15,10 +18,12 @@ from typing import (
 import aiohttp
 import anyio
 import anyio.abc
+import anyio.to_thread
 import cachetools
 from tqdm import tqdm
 from functools import lru_cache
 import apscheduler.schedulers.asyncio
+import pyzstd as zstd
 from tianxiu2b2t.anyio.future import Future
 
 from .logger import logger
@@ -30,25 +35,206 @@ K = TypeVar("K")
 V = TypeVar("V") 
 T = TypeVar("T")
 
-class AvroParser:
+@dataclass
+class FileListBatch:
+    """one batch of decoded file list records, column by column"""
+    paths: list[str] = field(default_factory=list)
+    hashes: list[str] = field(default_factory=list)
+    sizes: list[int] = field(default_factory=list)
+    mtimes: list[int] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.hashes)
+
+class FileListDecoder:
+    """
+    Streaming decoder for the file list of `/openbmclapi/files`: a zstd
+    compressed Avro array of `{path, hash, size, mtime}` records.
+
+    Compressed chunks go in through `feed` as they arrive and every call
+    returns the records completed so far as a `FileListBatch`, so neither
+    the whole decompressed payload nor per-byte reads are needed. Varints
+    are decoded straight from the byte buffer, with a fast path for the
+    common one-byte case. Avro array blocks (including negative counts
+    with a byte size) are handled; a record cut off at the end of a chunk
+    is kept until the next one.
+    """
     def __init__(
+        self
+    ):
+        self._decompressor = zstd.EndlessZstdDecompressor()
+        self._buffer = b""
+        self._remaining = 0
+        self.done = False
+        self.count = 0
+
+    def feed(
         self,
         data: bytes
+    ) -> FileListBatch:
+        self._buffer += self._decompressor.decompress(data)
+        return self._decode()
+
+    def finish(self):
+        # a stream cut at a block boundary leaves nothing buffered, only the
+        # missing end-of-array marker tells it apart from a complete list
+        if not self.done or self._remaining or self._buffer:
+            raise EOFError(f"file list truncated, {self._remaining} records and {len(self._buffer)} bytes left")
+
+    def _decode(self) -> FileListBatch:
+        batch = FileListBatch()
+        add_path, add_hash = batch.paths.append, batch.hashes.append
+        add_size, add_mtime = batch.sizes.append, batch.mtimes.append
+        buf = self._buffer
+        pos = 0
+        remaining = self._remaining
+        decoded = 0
+        try:
+            while not self.done:
+                if remaining == 0:
+                    count, p = read_long(buf, pos)
+                    if count == 0:
+                        self.done = True
+                        pos = p
+                        break
+                    if count < 0:
+                        count = -count
+                        _, p = read_long(buf, p)
+                    remaining = count
+                    pos = p
+                # path and hash: short strings, one byte length almost always
+                b = buf[pos]
+                if b < 0x80:
+                    p = pos + 1 + (b >> 1)
+                    path = buf[pos + 1:p]
+                else:
+                    length, p = read_long(buf, pos)
+                    path = buf[p:p + length]
+                    p += length
+                b = buf[p]
+                if b < 0x80:
+                    end = p + 1 + (b >> 1)
+                    hash = buf[p + 1:end]
+                else:
+                    length, end = read_long(buf, p)
+                    hash = buf[end:end + length]
+                    end += length
+                # size and mtime, zigzag encoded and never negative
+                b = buf[end]
+                size = b & 0x7F
+                shift = 7
+                end += 1
+                while b & 0x80:
+                    b = buf[end]
+                    size |= (b & 0x7F) << shift
+                    shift += 7
+                    end += 1
+                b = buf[end]
+                mtime = b & 0x7F
+                shift = 7
+                end += 1
+                while b & 0x80:
+                    b = buf[end]
+                    mtime |= (b & 0x7F) << shift
+                    shift += 7
+                    end += 1
+                add_path(path.decode("utf-8"))
+                add_hash(hash.decode("ascii"))
+                add_size(size >> 1)
+                add_mtime(mtime >> 1)
+                remaining -= 1
+                decoded += 1
+                pos = end
+        except IndexError:
+            # record continues in the next chunk
+            ...
+        self._buffer = buf[pos:]
+        self._remaining = remaining
+        self.count += decoded
+        return batch
+
+def read_long(
+    buf: bytes,
+    pos: int
+) -> tuple[int, int]:
+    """zigzag varint at `pos`, returns the value and the next position"""
+    b = buf[pos]
+    result = b & 0x7F
+    shift = 7
+    pos += 1
+    while b & 0x80:
+        b = buf[pos]
+        result |= (b & 0x7F) << shift
+        shift += 7
+        pos += 1
+    return (result >> 1) ^ -(result & 1), pos
+
+class AIMDController:
+    """
+    Concurrency limit tuned by additive increase / multiplicative decrease.
+
+    Progress and failures are reported as they happen and the limit is
+    re-evaluated once per `window` seconds: a throttling answer (429) or
+    an error rate above `error_rate` halves it, otherwise it grows by one
+    as long as throughput keeps up with the previous window.
+    """
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = 1,
+        maximum: int = 64,
+        window: float = 2.0,
+        decrease: float = 0.5,
+        error_rate: float = 0.1,
+        tolerance: float = 0.1
     ):
-        self.data = io.BytesIO(data)
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self._limit = float(min(max(initial, minimum), self.maximum))
+        self.window = window
+        self.decrease = decrease
+        self.error_rate = error_rate
+        self.tolerance = tolerance
+        self._bytes = 0
+        self._successes = 0
+        self._errors = 0
+        self._throttled = 0
+        self._throughput = 0.0
+        self._window_start = time.monotonic()
 
-    def read_long(self): 
-        result, shift = 0, 0
-        while True:
-            byte = ord(self.data.read(1))
-            result |= (byte & 0x7F) << shift
-            if not (byte & 0x80):
-                break
-            shift += 7
-        return (result >> 1) ^ -(result & 1)
-    
-    def read_string(self):
-        return self.data.read(self.read_long()).decode('utf-8')
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def throughput(self) -> float:
+        """bytes per second over the last window"""
+        return self._throughput
+
+    def report(
+        self,
+        bytes: int = 0,
+        success: bool = False,
+        error: bool = False,
+        throttled: bool = False
+    ):
+        self._bytes += bytes
+        self._successes += success
+        self._errors += error or throttled
+        self._throttled += throttled
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        throughput = self._bytes / elapsed
+        finished = self._successes + self._errors
+        if self._throttled or (finished and self._errors / finished > self.error_rate):
+            self._limit = max(self.minimum, self._limit * self.decrease)
+        elif throughput >= self._throughput * (1 - self.tolerance):
+            self._limit = min(self.maximum, self._limit + 1)
+        self._throughput = throughput
+        self._bytes = self._successes = self._errors = self._throttled = 0
+        self._window_start = now
 
 class Event:
     def __init__(
@@ -112,6 +298,83 @@ def get_hash_obj(
         return hashlib.md5()
     return hashlib.sha1()
 
+HASH_CHUNK_SIZE = 1024 * 1024
+_hash_limiter: Optional[anyio.CapacityLimiter] = None
+
+def get_hash_limiter() -> anyio.CapacityLimiter:
+    """threads that may hash files at the same time"""
+    global _hash_limiter
+    if _hash_limiter is None:
+        _hash_limiter = anyio.CapacityLimiter(cfg.hash_workers)
+    return _hash_limiter
+
+def hash_local_file(
+    path: Path,
+    hash: str
+) -> str:
+    """hexdigest of `path` with the algorithm of `hash`, blocking"""
+    obj = get_hash_obj(hash)
+    with open(path, "rb") as f:
+        while (data := f.read(HASH_CHUNK_SIZE)):
+            obj.update(data)
+    return obj.hexdigest()
+
+HASH_PIPELINE_DEPTH = 4
+
+async def hash_stream(
+    chunks: AsyncIterable[bytes],
+    obj: Any,
+    sink: Optional[Callable[[bytes], Any]] = None
+) -> str:
+    """
+    Feeds `chunks` to the hash object `obj` (and `sink`, e.g. a file
+    write) on the hash thread pool and returns the hexdigest.
+
+    The chunks pass through a queue of `HASH_PIPELINE_DEPTH` so reading
+    the next chunk overlaps with hashing the previous one, and the event
+    loop never runs the digest itself. Errors of either side are raised
+    as they are, not wrapped in an exception group.
+    """
+    send, receive = anyio.create_memory_object_stream[bytes](HASH_PIPELINE_DEPTH)
+    error: Optional[BaseException] = None
+
+    def process(batch: list[bytes]):
+        for chunk in batch:
+            obj.update(chunk)
+            if sink is not None:
+                sink(chunk)
+
+    async def produce():
+        nonlocal error
+        async with send:
+            try:
+                async for chunk in chunks:
+                    await send.send(chunk)
+            except anyio.BrokenResourceError:
+                pass
+            except Exception as e:
+                error = e
+
+    async with anyio.create_task_group() as task_group:
+        task_group.start_soon(produce)
+        async with receive:
+            try:
+                async for chunk in receive:
+                    # whatever queued up meanwhile goes in the same thread hop
+                    batch = [chunk]
+                    try:
+                        while True:
+                            batch.append(receive.receive_nowait())
+                    except (anyio.WouldBlock, anyio.EndOfStream):
+                        pass
+                    await anyio.to_thread.run_sync(process, batch, limiter=get_hash_limiter())
+            except Exception as e:
+                error = e
+                task_group.cancel_scope.cancel()
+    if error is not None:
+        raise error
+    return obj.hexdigest()
+
 @lru_cache(maxsize=1024)
 def get_certificate_type() -> CertificateType:
     ret = CertificateType.CLUSTER
@@ -126,29 +389,37 @@ def get_certificate_type() -> CertificateType:
     logger.tinfo(f"web.byoc", type=ret)
     return ret
 
-def get_range_size(range: str, size: Optional[int] = None):
-    if range.startswith("bytes="):
-        range = range[6:]
-    if "-" in range:
-        start, end = range.split("-")
-        if end:
-            return int(end) - int(start) + 1
-        elif size is not None:
-            return size - int(start)
-    elif size is not None:
-        start = int(range)
-        return size - start
-    return size
-
-def parse_range(range: str):
+def parse_range(range: str, size: int) -> Optional['RangeResult']:
+    """
+    Resolve a single `Range` header against a body of `size` bytes.
+
+    Returns None when the whole body should be served (no header, a
+    malformed one or a multi-range request, which RFC 9110 allows us to
+    ignore) and raises `RangeNotSatisfiable` when it cannot be served.
+    """
     if not range or not range.startswith("bytes="):
         return None
-    range = range[6:]
-    start, end = range.split("-")
-    return RangeResult(
-        start=int(start),
-        end=int(end) if end else None
-    )
+    spec = range[6:].strip()
+    if "," in spec:
+        return None
+    start, sep, end = spec.partition("-")
+    if not sep:
+        return None
+    try:
+        if not start.strip():
+            suffix = int(end)
+            if suffix <= 0:
+                raise RangeNotSatisfiable(size)
+            return RangeResult(max(0, size - suffix), size - 1)
+        first = int(start)
+        last = int(end) if end.strip() else size - 1
+    except ValueError:
+        return None
+    if last < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable(size)
+    return RangeResult(first, min(last, size - 1))
 
 class SubTQDM:
     def __init__(self, total: float, description: str = "", position: int = 0, leave: bool = True, **kwargs):
@@ -242,11 +513,26 @@ class RangeResult:
     def __init__(
         self,
         start: int,
-        end: Optional[int],
+        end: int,
     ):
         self.start = start
         self.end = end
 
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+    def content_range(self, size: int):
+        return f"bytes {self.start}-{self.end}/{size}"
+
+class RangeNotSatisfiable(Exception):
+    def __init__(
+        self,
+        size: int
+    ):
+        super().__init__(f"Range not satisfiable for {size} bytes")
+        self.size = size
+
 class UnboundTTLCache(cachetools.TTLCache[K, V]):
     def __init__(self, maxsize: Optional[float], ttl: float, timer=time.monotonic):
         cachetools.TTLCache.__init__(self, maxsize or math.inf, ttl, timer)
@@ -255,6 +541,75 @@ class UnboundTTLCache(cachetools.TTLCache[K, V]):
     def maxsize(self):
         return None
 
+class SpaceSaving(Generic[K]):
+    """
+    Space-Saving top-k sketch over a stream of keys, in bounded memory.
+
+    At most `capacity` keys are counted. A new key replaces the one with
+    the smallest count and inherits it as its error bound, so every key
+    whose true count exceeds total / capacity is guaranteed to be kept.
+    The min-heap is repaired lazily: entries are only re-pushed with their
+    current count when they surface, which keeps `add` amortised O(log k).
+    """
+    def __init__(
+        self,
+        capacity: int = 1024
+    ):
+        self.capacity = capacity
+        # key -> [hits, error, bytes]
+        self._counters: dict[K, list[int]] = {}
+        self._heap: list[tuple[int, K]] = []
+        self.total = 0
+
+    def add(
+        self,
+        key: K,
+        bytes: int = 0
+    ):
+        self.total += 1
+        counter = self._counters.get(key)
+        if counter is not None:
+            counter[0] += 1
+            counter[2] += bytes
+            return
+        if len(self._counters) < self.capacity:
+            self._counters[key] = [1, 0, bytes]
+            heapq.heappush(self._heap, (1, key))
+            return
+        while True:
+            count, victim = self._heap[0]
+            current = self._counters[victim][0]
+            if current == count:
+                break
+            heapq.heapreplace(self._heap, (current, victim))
+        del self._counters[victim]
+        self._counters[key] = [count + 1, count, bytes]
+        heapq.heapreplace(self._heap, (count + 1, key))
+
+    def top(
+        self,
+        n: Optional[int] = None
+    ) -> list[tuple[K, int, int, int]]:
+        """(key, hits, error, bytes) by hits, highest first"""
+        items = sorted(self._counters.items(), key=lambda x: x[1][0], reverse=True)
+        return [(key, *counter) for key, counter in items[:n]] # type: ignore
+
+    def load(
+        self,
+        items: list[tuple[K, int, int, int]],
+        total: int = 0
+    ):
+        self._counters = {
+            key: [hits, error, bytes]
+            for key, hits, error, bytes in items[:self.capacity]
+        }
+        self._heap = [(counter[0], key) for key, counter in self._counters.items()]
+        heapq.heapify(self._heap)
+        self.total = total
+
+    def __len__(self):
+        return len(self._counters)
+
 def debug_aiohttp_response(
     response: aiohttp.ClientResponse,
     body: Any
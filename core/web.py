@@ -1,8 +1,18 @@
-from collections import defaultdict
+import asyncio
+import bisect
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass
 import datetime
+import os
+from pathlib import Path
+import socket
 import ssl
+import time
+from typing import Any, Awaitable, Callable, MutableMapping, Optional
+import urllib.parse as urlparse
 import anyio
 import anyio.abc
+import anyio.to_thread
 import anyio.streams
 import anyio.streams.tls
 import fastapi
@@ -14,10 +24,17 @@ from tianxiu2b2t.utils import runtime
 from tianxiu2b2t.http.asgi import ASGIApplicationBridge, ASGIConfig, ASGIListener
 
 from . import utils, abc
-from .logger import logger
+from .logger import access_logger, logger
 from .config import cfg
 from .locale import t
 from .cluster import ClusterManager
+from .workers import REUSE_PORT_SUPPORTED
+
+Scope = MutableMapping[str, Any]
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIHandler = Callable[[Scope, Receive, Send], Awaitable[None]]
 
 class ForwardAddress:
     def __init__(
@@ -39,44 +56,73 @@ class ForwardAddress:
             del forwards[self.sockname]
             del forwards_count[self.sockname]
 
+# upper bounds in milliseconds, the last bucket is everything slower
+LATENCY_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
 class QueryPerSecondStatistics:
+    """
+    Per-second request statistics over the last `expires` seconds.
+
+    Slots live in fixed-size arrays indexed by `second % expires`; a slot
+    is reset the first time a new second lands on it, so `add` is O(1) and
+    readers only walk the arrays, without locking or copying.
+    Each slot holds request count, bytes sent, status classes and a small
+    latency histogram (see `LATENCY_BUCKETS`).
+    """
     def __init__(
         self,
         expires: int = 600
     ):
         self._timer = lambda: runtime.monotonic()
-        self._data: defaultdict[int, int] = defaultdict(int)
         self._expires = expires
+        self._seconds = [-1] * expires
+        self._requests = [0] * expires
+        self._bytes = [0] * expires
+        self._status = [[0] * len(STATUS_CLASSES) for _ in range(expires)]
+        self._latency = [[0] * (len(LATENCY_BUCKETS) + 1) for _ in range(expires)]
 
+    def add(
+        self,
+        status: int = 200,
+        bytes: int = 0,
+        latency: int = 0
+    ):
+        """`latency` in nanoseconds"""
+        second = int(self._timer())
+        i = second % self._expires
+        if self._seconds[i] != second:
+            self._seconds[i] = second
+            self._requests[i] = 0
+            self._bytes[i] = 0
+            self._status[i][:] = (0,) * len(STATUS_CLASSES)
+            self._latency[i][:] = (0,) * (len(LATENCY_BUCKETS) + 1)
+        self._requests[i] += 1
+        self._bytes[i] += bytes
+        self._status[i][min(max(status // 100 - 1, 0), len(STATUS_CLASSES) - 1)] += 1
+        self._latency[i][bisect.bisect_left(LATENCY_BUCKETS, latency / 1e6)] += 1
 
-    def add(self):
-        self._data[int(self._timer())] += 1
-        self.expire()
-    
-    def expire(self):
-        t = self._timer()
-        for k, v in list(self._data.items()):
-            if k + self._expires < t:
-                del self._data[k]
+    def _slots(self, stop: int):
+        """indexes of the complete seconds still in the window, up to `stop`"""
+        start = int(self._timer()) - self._expires
+        for i, second in enumerate(self._seconds):
+            if start < second <= stop:
+                yield i
 
     def get_all(self) -> dict[datetime.datetime, int]:
         now = datetime.datetime.now().replace(microsecond=0)
-        t = self._timer()
-        data = {}
-        for k, v in self._data.items():
-            if k >= t:
-                continue
-            data[(now - datetime.timedelta(seconds=t - k)).replace(microsecond=0)] += v
-        return data
+        t = int(self._timer())
+        data: defaultdict[datetime.datetime, int] = defaultdict(int)
+        for i in self._slots(t - 1):
+            data[now - datetime.timedelta(seconds=t - self._seconds[i])] += self._requests[i]
+        return dict(sorted(data.items()))
     
     def merge_data(self, interval: int = 5) -> dict[datetime.datetime, int]:
         res: defaultdict[int, int] = defaultdict(int)
         timer = self._timer()
         stop_timer = timer - timer % interval
-        for k, v in self._data.items():
-            if k > stop_timer:
-                continue
-            res[k // interval] += v
+        for i in self._slots(int(stop_timer)):
+            res[self._seconds[i] // interval] += self._requests[i]
         
         now = datetime.datetime.now().timestamp()
         timestamp = datetime.datetime.fromtimestamp(
@@ -84,18 +130,327 @@ class QueryPerSecondStatistics:
         ).replace(microsecond=0)
         return {
             timestamp + datetime.timedelta(seconds=i * interval): n
-            for i, n in res.items()
+            for i, n in sorted(res.items())
         }
 
+    def get_details(self, interval: int = 5) -> list[dict[str, Any]]:
+        """requests, bytes, status classes and latency histogram per `interval` seconds"""
+        res: dict[int, dict[str, Any]] = {}
+        timer = self._timer()
+        stop_timer = timer - timer % interval
+        for i in self._slots(int(stop_timer)):
+            key = self._seconds[i] // interval
+            if key not in res:
+                res[key] = {
+                    "requests": 0,
+                    "bytes": 0,
+                    "status": [0] * len(STATUS_CLASSES),
+                    "latency": [0] * (len(LATENCY_BUCKETS) + 1),
+                }
+            item = res[key]
+            item["requests"] += self._requests[i]
+            item["bytes"] += self._bytes[i]
+            for j, n in enumerate(self._status[i]):
+                item["status"][j] += n
+            for j, n in enumerate(self._latency[i]):
+                item["latency"][j] += n
+
+        now = datetime.datetime.now().timestamp()
+        base = (now - now % interval) - stop_timer
+        return [
+            {
+                "time": datetime.datetime.fromtimestamp(base + key * interval).replace(microsecond=0),
+                "requests": item["requests"],
+                "bytes": item["bytes"],
+                "status": dict(zip(STATUS_CLASSES, item["status"])),
+                "latency": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["inf"], item["latency"])),
+            } for key, item in sorted(res.items())
+        ]
+
+
+class Application:
+    """
+    Raw ASGI entry point in front of the FastAPI app.
+
+    Hot paths registered with `route` are dispatched by path prefix and
+    skip FastAPI routing and middleware entirely, everything else falls
+    through to `app`. Access log and statistics are handled here for both.
+    Routed handlers are cancelled when the client disconnects, and must
+    not read the request body themselves.
+    """
+    def __init__(
+        self,
+        app: fastapi.FastAPI
+    ):
+        self.app = app
+        self.routes: list[tuple[str, ASGIHandler]] = []
+
+    def route(
+        self,
+        prefix: str
+    ):
+        def decorator(handler: ASGIHandler):
+            self.routes.append((prefix, handler))
+            return handler
+        return decorator
+
+    async def __call__(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send
+    ):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start_time = runtime.perf_counter_ns()
+        status = 500
+        started = False
+        sent = 0
+
+        async def send_wrapper(message: Message):
+            nonlocal status, started, sent
+            type = message["type"]
+            if type == "http.response.body":
+                sent += len(message.get("body", b""))
+            elif type == "http.response.start":
+                status = message["status"]
+                started = True
+            await send(message)
+
+        path: str = scope["path"]
+        handler: ASGIHandler = self.app
+        for prefix, route in self.routes:
+            if path.startswith(prefix):
+                handler = route
+                break
+
+        async def run():
+            try:
+                await handler(scope, receive, send_wrapper)
+            except anyio.get_cancelled_exc_class():
+                raise
+            except:
+                logger.traceback()
+                if not started:
+                    await send_response(send_wrapper, 500, INTERNAL_SERVER_ERROR_HEADERS, b"Internal Server Error")
+
+        if handler is self.app:
+            await run()
+        else:
+            # the server's send() silently drops what a gone client would get,
+            # so routed handlers are cancelled instead of sending into the void
+            async with anyio.create_task_group() as task_group:
+                task_group.start_soon(cancel_on_disconnect, receive, task_group.cancel_scope)
+                await run()
+                task_group.cancel_scope.cancel()
+
+        total_time = runtime.perf_counter_ns() - start_time
+        query_per_second_statistics.add(status, sent, total_time)
+        access_log(scope, status, total_time)
+
+async def cancel_on_disconnect(
+    receive: Receive,
+    cancel_scope: anyio.CancelScope
+):
+    """cancels `cancel_scope` once the client has disconnected"""
+    while (await receive())["type"] != "http.disconnect":
+        ...
+    cancel_scope.cancel()
+
+def get_header(
+    scope: Scope,
+    name: bytes
+) -> Optional[str]:
+    for key, value in scope["headers"]:
+        if isinstance(key, str):
+            key = key.encode("latin-1")
+        if key.lower() != name:
+            continue
+        if isinstance(value, bytes):
+            value = value.decode("latin-1")
+        return value
+    return None
+
+def get_query(
+    scope: Scope
+) -> dict[str, str]:
+    query_string = scope.get("query_string") or b""
+    if isinstance(query_string, bytes):
+        query_string = query_string.decode("latin-1")
+    return dict(urlparse.parse_qsl(query_string))
+
+def build_headers(
+    content_length: Optional[int] = None,
+    content_type: bytes = b"application/octet-stream",
+    **headers: str
+) -> list[tuple[bytes, bytes]]:
+    res = [(b"content-type", content_type)]
+    if content_length is not None:
+        res.append((b"content-length", str(content_length).encode()))
+    for key, value in headers.items():
+        res.append((key.replace("_", "-").lower().encode(), value.encode("latin-1")))
+    return res
+
+async def send_response(
+    send: Send,
+    status: int,
+    headers: list[tuple[bytes, bytes]],
+    body: bytes = b""
+):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers,
+    })
+    await send({
+        "type": "http.response.body",
+        "body": body,
+    })
+
+async def send_file(
+    send: Send,
+    path: Path,
+    size: int,
+    range: Optional[utils.RangeResult],
+    headers: list[tuple[bytes, bytes]],
+):
+    """
+    Send `path` (or the `range` of it) as the response body, read in
+    bounded chunks off the event loop.
+
+    There is no zero-copy path: uvicorn frames and counts every body byte
+    passed through `send`, so handing the socket to `os.sendfile` would
+    have to bypass its protocol state. Each chunk is a fresh `bytes`,
+    since a buffer reused across reads may still be queued in a transport.
+    """
+    offset, count, status = 0, size, 200
+    if range is not None:
+        offset, count, status = range.start, range.length, 206
+        headers.append((b"content-range", range.content_range(size).encode()))
+    headers.append((b"accept-ranges", b"bytes"))
+    file = await anyio.to_thread.run_sync(open, path, "rb")
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers,
+        })
+        if count == 0:
+            await send({
+                "type": "http.response.body",
+                "body": b"",
+            })
+            return
+        await anyio.to_thread.run_sync(file.seek, offset)
+        while count > 0:
+            data = await anyio.to_thread.run_sync(file.read, min(count, SEND_FILE_CHUNK_SIZE))
+            if not data:
+                break
+            count -= len(data)
+            await send({
+                "type": "http.response.body",
+                "body": data,
+                "more_body": count > 0,
+            })
+        if count > 0:
+            # file shrank underneath us, let the server drop the connection
+            raise EOFError(f"{path} ended {count} bytes early")
+    finally:
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(file.close)
+
+async def send_stream(
+    send: Send,
+    file: abc.ResponseFileStream,
+    range: Optional[utils.RangeResult],
+    headers: list[tuple[bytes, bytes]],
+):
+    """
+    Proxy a backend stream to the client. The requested range is forwarded
+    upstream and every chunk waits for the client before the next is read;
+    a disconnect cancels it through `Application`.
+    """
+    offset, count, status = 0, file.size, 200
+    if range is not None:
+        offset, count, status = range.start, range.length, 206
+        headers.append((b"content-range", range.content_range(file.size).encode()))
+    headers.append((b"accept-ranges", b"bytes"))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers,
+    })
+    stream = file.stream(offset, count)
+    try:
+        async for chunk in stream:
+            count -= len(chunk)
+            await send({
+                "type": "http.response.body",
+                "body": chunk,
+                "more_body": True,
+            })
+    finally:
+        # releases the upstream response even when the client went away
+        with anyio.CancelScope(shield=True):
+            await stream.aclose() # type: ignore
+    if count != 0:
+        # backend ended early, let the server drop the connection
+        raise EOFError(f"stream ended {count} bytes early")
+    await send({
+        "type": "http.response.body",
+        "body": b"",
+    })
+
+def access_log(
+    scope: Scope,
+    status: int,
+    total_time: int
+):
+    raw_path: str = scope["path"]
+    # with query params
+    query_string = scope.get("query_string")
+    if query_string:
+        raw_path += "?" + (query_string.decode("latin-1") if isinstance(query_string, bytes) else query_string)
+    
+    if not cfg.access_log and (
+        raw_path.startswith("/download/") or raw_path.startswith("/measure/")
+    ) and status in (200, 206, 302):
+        return
+
+    address = get_header(scope, b"x-real-ip") or ""
+    client = scope.get("client")
+    if not address and client:
+        address = get_origin_address((client[0], client[1]))[0]
+    access_logger.log(
+        time.time(),
+        address,
+        get_header(scope, b"host") or "",
+        scope["method"],
+        raw_path,
+        status,
+        total_time,
+        get_header(scope, b"user-agent") or "",
+    )
+
+
+INTERNAL_SERVER_ERROR_HEADERS = build_headers(21, b"text/plain; charset=utf-8")
+SEND_FILE_CHUNK_SIZE = 1024 * 256
+SPLICE_SIZE = 1024 * 1024
+CERTIFICATE_CHECK_INTERVAL = 60
+SPLICE_SUPPORTED = hasattr(os, "splice")
 
 app = fastapi.FastAPI(
     redoc_url=None,
     docs_url=None,
     openapi_url=None,
 )
+application = Application(app)
 http_port = -1
+server: uvicorn.Server | None = None
 certificates: list[abc.Certificate] = []
-tls_listener: streams.AutoTLSListener | None = None
+tls_listener: 'TLSListener | None' = None
+certificate_mtimes: dict[str, tuple[abc.Certificate, float]] = {}
 forwards: dict[tuple[str, int], tuple[str, int]] = {}
 forwards_count: defaultdict[tuple[str, int], int] = defaultdict(int)
 query_per_second_statistics = QueryPerSecondStatistics()
@@ -105,6 +460,329 @@ async def get_free_port():
     port = listener.extra(anyio.abc.SocketAttribute.local_port)
     return port
 
+class StreamTransport(asyncio.Transport):
+    """
+    asyncio transport over an anyio byte stream.
+
+    Lets uvicorn's own HTTP protocol run directly on the (already TLS or
+    PROXY terminated) public stream, so requests reach the application
+    in-process with full HTTP/1.1 behaviour and no loopback hop.
+    Writes are queued and sent by `serve`, with the usual pause / resume
+    writing flow control towards the protocol.
+    """
+    def __init__(
+        self,
+        stream: anyio.abc.ByteStream,
+        protocol: asyncio.Protocol,
+        extra: dict[str, Any],
+        high_water: int = 1024 * 256,
+        low_water: int = 1024 * 64
+    ):
+        super().__init__(extra)
+        self._stream = stream
+        self._protocol = protocol
+        self._high_water = high_water
+        self._low_water = low_water
+        self._buffer: deque[bytes] = deque()
+        self._buffer_size = 0
+        self._closing = False
+        self._writing_paused = False
+        self._reading = asyncio.Event()
+        self._reading.set()
+        self._writable = asyncio.Event()
+        self._exc: Optional[Exception] = None
+
+    async def serve(self):
+        self._protocol.connection_made(self)
+        try:
+            async with anyio.create_task_group() as task_group:
+                task_group.start_soon(self._read_loop)
+                await self._write_loop()
+                task_group.cancel_scope.cancel()
+        finally:
+            self._protocol.connection_lost(self._exc)
+
+    async def _read_loop(self):
+        while not self._closing:
+            await self._reading.wait()
+            try:
+                data = await self._stream.receive()
+            except (
+                anyio.EndOfStream,
+                anyio.BrokenResourceError,
+                anyio.ClosedResourceError,
+                ssl.SSLError,
+                OSError
+            ):
+                if not self._protocol.eof_received():
+                    self.close()
+                return
+            self._protocol.data_received(data)
+
+    async def _write_loop(self):
+        while True:
+            while self._buffer:
+                data = self._buffer.popleft()
+                try:
+                    await self._stream.send(data)
+                except Exception as e:
+                    self._exc = e
+                    self.abort()
+                    return
+                self._buffer_size -= len(data)
+                if self._writing_paused and self._buffer_size <= self._low_water:
+                    self._writing_paused = False
+                    self._protocol.resume_writing()
+            if self._closing:
+                return
+            self._writable.clear()
+            await self._writable.wait()
+
+    def write(self, data: bytes | bytearray | memoryview):
+        if self._closing or not data:
+            return
+        self._buffer.append(bytes(data))
+        self._buffer_size += len(data)
+        self._writable.set()
+        if not self._writing_paused and self._buffer_size > self._high_water:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def writelines(self, list_of_data):
+        for data in list_of_data:
+            self.write(data)
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def get_write_buffer_size(self) -> int:
+        return self._buffer_size
+
+    def get_write_buffer_limits(self) -> tuple[int, int]:
+        return self._low_water, self._high_water
+
+    def set_write_buffer_limits(self, high: Optional[int] = None, low: Optional[int] = None):
+        self._high_water = high if high is not None else 1024 * 256
+        self._low_water = low if low is not None else self._high_water // 4
+
+    def pause_reading(self):
+        self._reading.clear()
+
+    def resume_reading(self):
+        self._reading.set()
+
+    def is_reading(self) -> bool:
+        return self._reading.is_set()
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        self._closing = True
+        self._reading.set()
+        self._writable.set()
+
+    def abort(self):
+        self._buffer.clear()
+        self._buffer_size = 0
+        self.close()
+
+    def set_protocol(self, protocol: asyncio.BaseProtocol):
+        self._protocol = protocol # type: ignore
+
+    def get_protocol(self) -> asyncio.BaseProtocol:
+        return self._protocol
+
+@dataclass
+class HandshakeStatistics:
+    full: int = 0
+    full_time: float = 0
+    resumed: int = 0
+    resumed_time: float = 0
+    failed: int = 0
+
+class TLSListener(streams.AutoTLSListener):
+    """
+    `AutoTLSListener` where every handshake starts on one session context.
+
+    The per-certificate contexts are only switched in from `sni_callback`,
+    so the OpenSSL session cache and ticket keys (which stay with the
+    initial context) are shared by every SNI name. `rotate` replaces the
+    session context, which rotates the ticket keys; connections already
+    established keep their context. Full and resumed handshakes are
+    counted and timed separately.
+
+    The previous session context stays valid for one rotation period: a
+    ClientHello offering a ticket is started on the context whose ticket
+    key name (the first 16 bytes of an OpenSSL ticket) it carries, so
+    tickets issued before the last rotation still resume.
+    """
+    def __init__(
+        self,
+        listener: anyio.abc.Listener,
+    ):
+        super().__init__(listener)
+        self.contexts = self._contexts
+        self._contexts = self # type: ignore
+        self.session_context: Optional[ssl.SSLContext] = None
+        # ticket key name -> session context, the current and the previous one
+        self.ticket_contexts: dict[bytes, ssl.SSLContext] = {}
+        self.rotated_at = 0.0
+        self.statistics = HandshakeStatistics()
+
+    def add_context(self, hostname: str, context: ssl.SSLContext) -> None:
+        self.contexts.add_context(hostname, context)
+
+    def get_context(self, hostname: str) -> ssl.SSLContext:
+        return self.session_context or self.contexts.get_context(hostname)
+
+    def rotate(self, certificate: abc.Certificate):
+        context = create_ssl_context(certificate)
+        name = get_ticket_key_name(context)
+        context.sni_callback = self._sni_callback
+        previous = self.session_context
+        self.ticket_contexts = {
+            key: value for key, value in self.ticket_contexts.items() if value is previous
+        }
+        if name is not None:
+            self.ticket_contexts[name] = context
+        self.session_context = context
+        self.rotated_at = runtime.monotonic()
+
+    def _sni_callback(
+        self,
+        ssl_object: ssl.SSLObject,
+        server_name: Optional[str],
+        context: ssl.SSLContext
+    ):
+        try:
+            ssl_object.context = self.contexts.get_context(server_name or "*")
+        except:
+            return ssl.ALERT_DESCRIPTION_INTERNAL_ERROR
+        return None
+
+    async def auto_tls_wrap(
+        self,
+        stream: streams.BufferedByteStream,
+        extra: streams.TLSExtraData
+    ) -> streams.BufferedByteStream:
+        start = runtime.perf_counter()
+        header = await stream.pre_readexactly(3)
+        if header[0] != 0x16:
+            return stream
+        extra.version = ssl.TLSVersion(int.from_bytes(header[1:]))
+        # the ClientHello record
+        hello = await stream.pre_readexactly(int.from_bytes(await stream.pre_readexactly(2), "big"))
+        ticket_name = None
+        try:
+            extra.hostname, ticket_name = parse_client_hello(hello)
+        except (IndexError, UnicodeDecodeError):
+            # malformed or split over records, the handshake decides
+            ...
+        context = self.ticket_contexts.get(ticket_name) if ticket_name else None
+        try:
+            with anyio.fail_after(self.handshake_timeout):
+                wrapped = streams.BufferedByteStream(
+                    await anyio.streams.tls.TLSStream.wrap(
+                        stream,
+                        ssl_context=context or self.get_context(extra.hostname or "*"),
+                        standard_compatible=self.standard_compatible,
+                    )
+                )
+        except BaseException as exc:
+            self.statistics.failed += 1
+            await anyio.aclose_forcefully(stream)
+            raise anyio.ClosedResourceError from exc
+        ssl_object = wrapped.extra(anyio.streams.tls.TLSAttribute.ssl_object, None)
+        if ssl_object is None:
+            return wrapped
+        total_time = runtime.perf_counter() - start
+        if ssl_object.session_reused:
+            self.statistics.resumed += 1
+            self.statistics.resumed_time += total_time
+        else:
+            self.statistics.full += 1
+            self.statistics.full_time += total_time
+        return wrapped
+
+    def get_statistics(self) -> dict[str, Any]:
+        statistics = self.statistics
+        return {
+            **asdict(statistics),
+            "full_avg": statistics.full_time / statistics.full if statistics.full else 0,
+            "resumed_avg": statistics.resumed_time / statistics.resumed if statistics.resumed else 0,
+            "rotated_at": self.rotated_at,
+        }
+
+def parse_client_hello(
+    hello: bytes
+) -> tuple[Optional[str], Optional[bytes]]:
+    """server name and ticket key name offered by a ClientHello handshake message"""
+    # type and length, version and random
+    pos = 4 + 2 + 32
+    # session id, cipher suites, compression methods
+    pos += 1 + hello[pos]
+    pos += 2 + int.from_bytes(hello[pos:pos + 2], "big")
+    pos += 1 + hello[pos]
+    end = pos + 2 + int.from_bytes(hello[pos:pos + 2], "big")
+    pos += 2
+    hostname, ticket = None, None
+    while pos + 4 <= end:
+        type = int.from_bytes(hello[pos:pos + 2], "big")
+        length = int.from_bytes(hello[pos + 2:pos + 4], "big")
+        data = hello[pos + 4:pos + 4 + length]
+        pos += 4 + length
+        if type == 0x00:
+            hostname = data[5:].decode("utf-8")
+        elif type == 0x23 and data:
+            # session_ticket (TLS 1.2)
+            ticket = data
+        elif type == 0x29:
+            # pre_shared_key (TLS 1.3), the first identity
+            ticket = data[4:4 + int.from_bytes(data[2:4], "big")]
+    return hostname, ticket[:16] if ticket else None
+
+def get_ticket_key_name(
+    context: ssl.SSLContext
+) -> Optional[bytes]:
+    """
+    Ticket key name of a server context, found by resuming a session
+    against it in memory: OpenSSL does not expose it otherwise.
+    """
+    client = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client.check_hostname = False
+    client.verify_mode = ssl.CERT_NONE
+    session = None
+    try:
+        for _ in range(2):
+            server_in, server_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+            client_in, client_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+            server_object = context.wrap_bio(server_in, server_out, server_side=True)
+            client_object = client.wrap_bio(client_in, client_out, session=session)
+            hello = None
+            for _ in range(4):
+                for ssl_object in (client_object, server_object):
+                    try:
+                        ssl_object.do_handshake()
+                    except ssl.SSLWantReadError:
+                        ...
+                data = client_out.read()
+                hello = hello or data
+                server_in.write(data)
+                client_in.write(server_out.read())
+            if session is not None:
+                # record header, then the ClientHello
+                return parse_client_hello(hello[5:])[1] if hello else None
+            try:
+                # the tickets arrive after the handshake
+                client_object.read(1)
+            except ssl.SSLWantReadError:
+                ...
+            session = client_object.session
+    except (ssl.SSLError, IndexError, UnicodeDecodeError):
+        logger.debug_traceback()
+    return None
+
 async def pub_listener(
     task_group: anyio.abc.TaskGroup
 ):
@@ -116,9 +794,10 @@ async def pub_listener(
         raise RuntimeError(t("error.web.forward.pub_port", port=pub_port))
     listener = await anyio.create_tcp_listener(
         local_port=pub_port,
+        reuse_port=cfg.workers > 0 and REUSE_PORT_SUPPORTED,
     )
 
-    tls_listener = streams.AutoTLSListener(
+    tls_listener = TLSListener(
         streams_proxy.ProxyProtocolMixedListener(
             streams.FixedSocketListener(
                 listener
@@ -131,17 +810,45 @@ async def serve(
     listener: anyio.abc.Listener,
 ):
     logger.tinfo("web.forward.pub_port", port=pub_port)
-    if cfg.bridge_web_application:
+    mode = cfg.web_mode
+    if mode == "bridge":
         asgi_listener = ASGIListener(
             ASGIConfig(
-                app,
+                application,
             ),
             listener
         )
         await asgi_listener.serve()
         return
     async with listener:
-        await listener.serve(pub_handler)
+        await listener.serve(inprocess_handler if mode == "inprocess" else pub_handler)
+
+async def inprocess_handler(
+    sock: streams.BufferedByteStream,
+):
+    assert server is not None
+    config = server.config
+    protocol = config.http_protocol_class( # type: ignore
+        config=config,
+        server_state=server.server_state,
+        app_state=server.lifespan.state if hasattr(server, "lifespan") else {},
+    )
+    transport = StreamTransport(sock, protocol, {
+        "peername": get_peername(sock),
+        "sockname": get_sockname(sock),
+        "sslcontext": get_ssl_context(sock),
+    })
+    try:
+        async with sock:
+            await transport.serve()
+    except (
+        anyio.EndOfStream,
+        anyio.BrokenResourceError,
+        ssl.SSLError
+    ):
+        ...
+    except Exception as e:
+        logger.debug_traceback()
 
 async def pub_handler(
     sock: streams.BufferedByteStream,
@@ -177,7 +884,15 @@ async def forward(
                     if buffer:
                         await conn.send(buffer)
                     task_group.start_soon(forward_data, sock, conn)
-                    task_group.start_soon(forward_data, conn, sock)
+                    src = conn.extra(anyio.abc.SocketAttribute.raw_socket, None)
+                    dst = sock.extra(anyio.abc.SocketAttribute.raw_socket, None)
+                    if (
+                        SPLICE_SUPPORTED and src is not None and dst is not None and
+                        get_ssl_context(sock) is None
+                    ):
+                        task_group.start_soon(splice_data, src, dst)
+                    else:
+                        task_group.start_soon(forward_data, conn, sock)
     except:
         raise
 
@@ -191,6 +906,12 @@ def get_peername(
 ) -> tuple[str, int]:
     return sock.extra(anyio.abc.SocketAttribute.remote_address) # type: ignore
 
+def get_ssl_context(
+    sock: streams.BufferedByteStream
+) -> Optional[ssl.SSLContext]:
+    ssl_object = sock.extra(anyio.streams.tls.TLSAttribute.ssl_object, None)
+    return ssl_object.context if ssl_object is not None else None
+
 def get_origin_address(
     name: tuple[str, int]
 ) -> tuple[str, int]:
@@ -211,13 +932,51 @@ async def forward_data(
         except:
             ...
 
+async def splice_data(
+    src: socket.socket,
+    dst: socket.socket
+):
+    """
+    Move bytes from `src` to `dst` through a pipe with splice(2), they
+    never enter userspace. Only for plain sockets, TLS has to go through
+    `forward_data`. Duplicated descriptors are polled, since the originals
+    are registered with their (read-paused) transports.
+    """
+    src, dst = src.dup(), dst.dup()
+    r, w = os.pipe()
+    try:
+        while 1:
+            try:
+                n = os.splice(src.fileno(), w, SPLICE_SIZE, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                await anyio.wait_socket_readable(src)
+                continue
+            if n == 0:
+                break
+            while n > 0:
+                try:
+                    n -= os.splice(r, dst.fileno(), n, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                except BlockingIOError:
+                    await anyio.wait_socket_writable(dst)
+    except OSError:
+        ...
+    finally:
+        os.close(r)
+        os.close(w)
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            ...
+        src.close()
+        dst.close()
+
 async def setup(
     task_group: anyio.abc.TaskGroup,
     clusters: ClusterManager
 ):
-    global http_port, certificates
+    global http_port, certificates, server
     config = uvicorn.Config(
-        app,
+        application,
         host="127.0.0.1",
         port=await get_free_port(),
         log_config={
@@ -225,7 +984,9 @@ async def setup(
         }
     )
     http_port = config.port
-    task_group.start_soon(uvicorn.Server(config).serve)
+    config.load()
+    server = uvicorn.Server(config)
+    task_group.start_soon(server.serve)
 
     logger.tdebug("web.uvicorn.port", port=config.port)
 
@@ -246,21 +1007,72 @@ async def setup(
 
     update_certificates(certificates)
 
+    task_group.start_soon(watch_certificates)
+
+def create_ssl_context(
+    cert: abc.Certificate
+) -> ssl.SSLContext:
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert.cert, cert.key)
+    context.check_hostname = False
+    context.hostname_checks_common_name = False
+    context.verify_mode = ssl.CERT_NONE
+    if cfg.web_mode == "bridge":
+        context.set_alpn_protocols(["h2", "http/1.1"])
+    return context
+
 def update_certificates(
     certicates: list[abc.Certificate]
 ):
     assert tls_listener is not None
     for cert in certicates:
-        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        context.load_cert_chain(cert.cert, cert.key)
-        context.check_hostname = False
-        context.hostname_checks_common_name = False
-        context.verify_mode = ssl.CERT_NONE
-        if cfg.bridge_web_application:
-            context.set_alpn_protocols(["h2", "http/1.1"])
+        context = create_ssl_context(cert)
 
         for domain in cert.domains:
             tls_listener.add_context(
                 domain,
                 context
-            )
\ No newline at end of file
+            )
+        certificate_mtimes[cert.cert] = (cert, get_certificate_mtime(cert))
+    if certicates and tls_listener.session_context is None:
+        tls_listener.rotate(certicates[0])
+
+def get_certificate_mtime(
+    cert: abc.Certificate
+) -> float:
+    try:
+        return max(Path(cert.cert).stat().st_mtime, Path(cert.key).stat().st_mtime)
+    except OSError:
+        return 0
+
+async def watch_certificates():
+    """
+    Reload certificates whose files changed and rotate the session
+    context (and with it the ticket keys) every `tls_session_rotation`.
+    Handshakes in progress and open connections keep their context.
+    """
+    while 1:
+        await anyio.sleep(CERTIFICATE_CHECK_INTERVAL)
+        if tls_listener is None:
+            continue
+        for cert, mtime in list(certificate_mtimes.values()):
+            current = get_certificate_mtime(cert)
+            if current == mtime:
+                continue
+            try:
+                new_cert = abc.Certificate(cert.cert_type, cert.cert, cert.key)
+                update_certificates([new_cert])
+                logger.tinfo("web.certificate.reload", cert=cert.cert, domains=", ".join(new_cert.domains))
+            except:
+                # probably half written, retry on the next check
+                logger.debug_traceback()
+        if (
+            certificate_mtimes and
+            runtime.monotonic() - tls_listener.rotated_at >= cfg.tls_session_rotation
+        ):
+            cert, _ = next(iter(certificate_mtimes.values()))
+            try:
+                tls_listener.rotate(cert)
+                logger.tdebug("web.certificate.rotate")
+            except:
+                logger.debug_traceback()
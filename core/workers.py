@@ -0,0 +1,114 @@
+import multiprocessing
+import multiprocessing.process
+import socket
+from multiprocessing import shared_memory
+from typing import Any, Callable, Optional
+
+from .logger import logger
+
+REUSE_PORT_SUPPORTED = hasattr(socket, "SO_REUSEPORT")
+
+class SharedCounters:
+    """
+    Hits / bytes per worker and cluster in one shared memory segment.
+
+    Every worker only ever writes its own row, so no locking is needed.
+    The counters only grow; the main process `collect`s the difference
+    since the last collection, which keeps keepalive totals exact.
+    """
+    def __init__(
+        self,
+        workers: int,
+        clusters: list[str],
+        name: Optional[str] = None
+    ):
+        self.workers = workers
+        self.clusters = {id: i for i, id in enumerate(clusters)}
+        self._owner = name is None
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=max(workers * len(clusters) * 2, 1) * 8)
+        else:
+            # workers are spawned by the main process and share its resource
+            # tracker, so attaching does not hand over ownership of the segment
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._values = self._shm.buf.cast("q")
+        self._collected = [0] * (len(clusters) * 2)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def add(
+        self,
+        worker: int,
+        cluster_id: str,
+        bytes: int
+    ):
+        i = (worker * len(self.clusters) + self.clusters[cluster_id]) * 2
+        self._values[i] += 1
+        self._values[i + 1] += bytes
+
+    def collect(
+        self,
+        cluster_id: str
+    ) -> tuple[int, int]:
+        """hits and bytes added by all workers since the last call"""
+        c = self.clusters[cluster_id]
+        hits, bytes = 0, 0
+        for worker in range(self.workers):
+            i = (worker * len(self.clusters) + c) * 2
+            hits += self._values[i]
+            bytes += self._values[i + 1]
+        hits, self._collected[c * 2] = hits - self._collected[c * 2], hits
+        bytes, self._collected[c * 2 + 1] = bytes - self._collected[c * 2 + 1], bytes
+        return hits, bytes
+
+    def close(self):
+        self._values.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+class WorkerManager:
+    def __init__(
+        self
+    ):
+        self.processes: list[multiprocessing.process.BaseProcess] = []
+        self.counters: Optional[SharedCounters] = None
+
+    def start(
+        self,
+        target: Callable[..., Any],
+        workers: int,
+        clusters: list[str]
+    ) -> Optional[SharedCounters]:
+        if workers <= 0:
+            return None
+        if not REUSE_PORT_SUPPORTED:
+            logger.twarning("core.worker.unsupported")
+            return None
+        self.counters = SharedCounters(workers, clusters)
+        context = multiprocessing.get_context("spawn")
+        for index in range(workers):
+            process = context.Process(
+                target=target,
+                args=(index, self.counters.name),
+                name=f"Worker-{index}",
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+            logger.tinfo("core.worker.started", index=index, pid=process.pid)
+        return self.counters
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(5)
+        self.processes.clear()
+        if self.counters is not None:
+            self.counters.close()
+            self.counters = None
+
+workers = WorkerManager()
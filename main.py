@@ -1,4 +1,8 @@
 if __name__ == '__main__':
+    import sys
     import core
 
-    core.init()
\ No newline at end of file
+    if sys.argv[1:2] == ["migrate"]:
+        core.migrate(sys.argv[2:])
+    else:
+        core.init()